@@ -53,6 +53,7 @@ setup(
         'console_scripts': [
             'terms = terms.core.scripts.repl:repl',
             'initterms = terms.core.scripts.initterms:init_terms',
+            'upgradeterms = terms.core.scripts.upgradeterms:upgrade_terms',
             'kbdaemon = terms.core.scripts.kbdaemon:main',
             'make_graph = terms.core.scripts.class_graph:main',
         ],
@@ -67,7 +68,7 @@ setup(
         },
     install_requires = [
         'setuptools==34.3.3',
-        'sqlalchemy == 1.1.7',
+        'sqlalchemy == 1.3.24',
         'ply == 3.10',
     ],
 )
@@ -35,11 +35,6 @@ def register_exec_global(fun, name=''):
 
 
 def count(compiler, sen):
-    resp = compiler.parse(sen + '?')
-    if resp == 'false':
-        return 0
-    elif resp == 'true':
-        return 1
-    return len(resp)
+    return compiler.count(sen + '?')
 
 register_exec_global(count)
@@ -17,8 +17,11 @@
 # along with any part of the terms project.
 # If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import hashlib
 from urllib.request import urlopen
 
+import ply
 import ply.lex as lex
 import ply.yacc
 from ply.lex import TOKEN
@@ -28,10 +31,11 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from terms.core.patterns import SYMBOL_PAT, VAR_PAT, NUM_PAT, QUOTED_SYMBOL_PAT
 from terms.core.network import Network, CondIsa, CondIs, CondCode
-from terms.core.terms import isa, Predicate, Import
+from terms.core.terms import isa, are, Predicate, Import, PreparedQuestion
 from terms.core.exceptions import TermsSyntaxError, WrongObjectType, WrongLabel
 from terms.core.exceptions import ImportProblems, DuplicateWord
 from terms.core.exceptions import TermNotFound
+from terms.core.utils import LRUCache
 
 import logging
 logger = logging.getLogger(__name__)
@@ -189,9 +193,22 @@ class Lexer(object):
         logger.info("Illegal character '%s' at line %d" % (t.value[0], t.lexer.lineno))
         t.lexer.skip(1)
 
+    # lexers already built in this process, by their build options
+    _built = {}
+
     # Build the lexer
     def build(self, **kwargs):
-        self.lexer = lex.lex(module=self, **kwargs)
+        '''
+        Build the lexer, or rather clone the one already built
+        with the same options, binding its rules to self.
+        The clone gets its own stack of states, and starts in INITIAL.
+        '''
+        key = tuple(sorted(kwargs.items()))
+        if key not in self._built:
+            self._built[key] = lex.lex(module=self, **kwargs)
+        self.lexer = self._built[key].clone(self)
+        self.lexer.lexstatestack = []
+        self.lexer.begin('INITIAL')
 
     # Test it output
     def test(self, data):
@@ -205,17 +222,21 @@ class Lexer(object):
 
 class Parser(object):
 
+    # the connectives of the python code in rules are right associative,
+    # as they were when their conflicts were left to yacc to resolve as shifts
     precedence = (
         ('left', 'COMMA'),
         ('left', 'LPAREN'),
         ('left', 'SEMICOLON'),
+        ('right', 'SOPER', 'SPRED', 'SBAR', 'SAMP', 'SNOT'),
     )
 
     def __init__(
             self,
             lex_optimize=False,
             yacc_optimize=True,
-            yacc_debug=False):
+            yacc_debug=False,
+            tables_dir=None):
 
         self.lex = Lexer()
 
@@ -223,12 +244,56 @@ class Parser(object):
             optimize=lex_optimize)
         self.tokens = self.lex.tokens
 
-        self.parser = ply.yacc.yacc(
+        tables = None
+        if tables_dir and yacc_optimize and not yacc_debug:
+            tables = self._get_tables_path(tables_dir)
+        if tables is not None and os.path.exists(tables):
+            try:
+                self.parser = self._yacc(True, False, tables)
+                return
+            except Exception as e:
+                logger.warning('Bad parser tables {}: {!r}'.format(tables, e))
+        if tables is None or not os.access(os.path.dirname(tables), os.W_OK):
+            self.parser = self._yacc(yacc_optimize, yacc_debug, None)
+        else:
+            tmp = '{}.{}'.format(tables, os.getpid())
+            self.parser = self._yacc(yacc_optimize, yacc_debug, tmp)
+            try:
+                os.replace(tmp, tables)
+            except OSError:
+                pass
+
+    def _yacc(self, optimize, debug, picklefile):
+        return ply.yacc.yacc(
             module=self,
             start='module',
             write_tables=False,
-            debug=yacc_debug,
-            optimize=yacc_optimize)
+            debug=debug,
+            optimize=optimize,
+            picklefile=picklefile)
+
+    def _get_tables_path(self, tables_dir):
+        '''
+        Get the path to the pickled LALR tables for this grammar,
+        in tables_dir, creating it if needed.
+        The name of the file carries the versions of ply and of its tables,
+        and a hash of the grammar, so stale tables are never loaded.
+        Return None if tables_dir cannot be created.
+        '''
+        tables_dir = os.path.expanduser(tables_dir)
+        try:
+            os.makedirs(tables_dir, exist_ok=True)
+        except OSError:
+            return None
+        grammar = [repr(self.precedence), ' '.join(self.tokens)]
+        for name in sorted(dir(self)):
+            if name.startswith('p_'):
+                grammar.append(getattr(self, name).__doc__ or '')
+        digest = hashlib.sha1('\n'.join(grammar).encode('utf8')).hexdigest()
+        name = 'parsetab-{}-{}-{}.pickle'.format(ply.__version__,
+                                                  ply.yacc.__tabversion__,
+                                                  digest[:16])
+        return os.path.join(tables_dir, name)
 
     def parse(self, text, filename='', debuglevel=0):
         """
@@ -346,18 +411,19 @@ class Parser(object):
             p[0] = (p[1],)
 
     def p_sentence_list(self, p):
-        '''sentence-list : sentence SEMICOLON sentence-list
-                         | sentence'''
+        '''sentence-list : fact-list
+                         | def-list'''
+        p[0] = p[1]
+
+    def p_def_list(self, p):
+        '''def-list : def SEMICOLON sentence-list
+                    | fact SEMICOLON def-list
+                    | def'''
         if len(p) == 4:
             p[0] = (p[1],) + p[3]
         else:
             p[0] = (p[1],)
 
-    def p_sentence(self, p):
-        '''sentence : def
-                    | fact'''
-        p[0] = p[1]
-
     def p_fact(self, p):
         '''fact : prefact
                 | var COLON prefact'''
@@ -456,7 +522,7 @@ class Parser(object):
     def p_sexpr(self, p):
         '''s-expr : SLPAREN s-expr SRPAREN s-conn SLPAREN s-expr SRPAREN
                   | SNOT SLPAREN s-expr SRPAREN
-                  | s-expr s-conn s-expr
+                  | s-expr s-conn s-expr %prec SOPER
                   | s-vnum'''
         if len(p) == 2:
             p[0] = p[1]
@@ -496,7 +562,7 @@ class Parser(object):
     def p_name_def(self, p):
         '''name-def : SYMBOL IS A term
                     | QSYMBOL IS A term
-                    | vterm IS A vterm'''
+                    | var IS A vterm'''
         if isinstance(p[1], str):
             p[1] = AstNode('term', val=p[1])
         p[0] = AstNode('name-def', name=p[1], term_type=p[4])
@@ -551,11 +617,43 @@ class Compiler(object):
         self.parser = Parser(
             lex_optimize=lex_optimize,
             yacc_optimize=yacc_optimize,
-            yacc_debug=yacc_debug)
-
-    def parse(self, s):
-        s = '\n'.join([l for l in s.splitlines() if l and not l.startswith('#')])
-        module = self.parser.parse(s)
+            yacc_debug=yacc_debug,
+            tables_dir=config.get('parser_tables_dir', '~/.cache/terms'))
+
+        self._ast_cache = LRUCache(int(config.get('ast_cache_size', 1000)))
+        self.ast_hits = 0
+        self.ast_misses = 0
+        self._prepared = {}
+
+    def _parse(self, s):
+        '''
+        Normalize the source, removing comments and blank lines,
+        and parse it into a module ast.
+        The asts are kept in an LRU cache keyed by the normalized source,
+        and must not be modified.
+        Return the normalized source and the ast.
+        '''
+        lines = [l.rstrip() for l in s.splitlines()]
+        s = '\n'.join([l for l in lines if l and not l.startswith('#')])
+        if not self._ast_cache.size:
+            return s, self.parser.parse(s)
+        try:
+            module = self._ast_cache[s]
+        except KeyError:
+            self.ast_misses += 1
+            module = self.parser.parse(s)
+            self._ast_cache[s] = module
+        else:
+            self.ast_hits += 1
+        return s, module
+
+    def parse(self, s, stream=False):
+        '''
+        Compile a series of constructs in the Terms language.
+        If stream is true and s is a single question,
+        its matches are returned as a generator.
+        '''
+        s, module = self._parse(s)
         url = module.url
         headers = module.headers
         known = False
@@ -568,9 +666,8 @@ class Compiler(object):
         if not known:
             asts = module.code
             if len(asts) == 1:
-                return self.compile(asts[0])
-            asts.reverse()
-            for ast in asts:
+                return self.compile(asts[0], stream=stream)
+            for ast in reversed(asts):
                 self.compile(ast)
             if url is not None:  # XXX Save import even if compile throws an exceptin, saving the line it was thrown at?
                 headers = '\n'.join(module.headers) if headers is not None else headers
@@ -579,7 +676,160 @@ class Compiler(object):
                 self.session.commit()
         return 'OK'
 
-    def compile(self, ast):
+    def parse_facts(self, s):
+        '''
+        Parse a series of fact-sets,
+        and add all their facts to the knowledge base as a single batch.
+        '''
+        s, module = self._parse(s)
+        preds = []
+        for ast in reversed(module.code):
+            if ast.type != 'fact-set':
+                raise TermsSyntaxError('Expecting only facts in a batch, '
+                        'found {!r} with attrs {!r}'.format(ast.type, ast.kwargs))
+            preds.extend([self.compile_fact(f) for f in ast.facts])
+        self.network.add_facts(preds)
+        self.session.commit()
+        return 'OK'
+
+    def explain(self, s):
+        '''
+        Describe the plan for a question,
+        without answering it.
+        '''
+        s, module = self._parse(s)
+        if len(module.code) != 1 or module.code[0].type != 'question':
+            raise TermsSyntaxError('Can only explain a single question')
+        facts = [f for f in module.code[0].facts if f.type == 'fact']
+        return self.network.explain(*[self.compile_fact(f) for f in facts])
+
+    def count(self, s):
+        '''
+        Count the matches for a question.
+        A question with only facts is counted in the db,
+        without loading its matches;
+        one with definitions is answered, and its matches counted.
+        '''
+        s, module = self._parse(s)
+        if len(module.code) != 1 or module.code[0].type != 'question':
+            raise TermsSyntaxError('Can only count a single question')
+        sentences = module.code[0].facts
+        if all(f.type == 'fact' for f in sentences):
+            return self.network.count(*[self.compile_fact(f) for f in sentences])
+        resp = self.compile_question(sentences)
+        if resp == 'false':
+            return 0
+        elif resp == 'true':
+            return 1
+        return len(resp)
+
+    def page(self, s, limit=None, offset=None, order=None):
+        '''
+        Stream a page of the matches for a question,
+        optionally sorted by a number variable,
+        prefixed with a minus for descending order.
+        '''
+        q = self._question(s, 'page')
+        if order is not None:
+            vars = {}
+            for pred in q:
+                self._collect_vars(pred, vars)
+            var = vars.get(order.lstrip('-'))
+            if var is None or var.term_type != self.lexicon.number:
+                raise TermsSyntaxError('Can only order by a number variable, '
+                                       'not ' + order.lstrip('-'))
+        return self.network.iquery(*q, limit=limit, offset=offset, order=order)
+
+    def _question(self, s, action):
+        s, module = self._parse(s)
+        if len(module.code) != 1 or module.code[0].type != 'question':
+            raise TermsSyntaxError('Can only %s a single question' % action)
+        if any(f.type != 'fact' for f in module.code[0].facts):
+            raise TermsSyntaxError('Can only %s questions with only facts' % action)
+        return [self.compile_fact(f) for f in module.code[0].facts]
+
+    def prepare(self, name, s, params=()):
+        '''
+        Register a question by name,
+        to be answered many times with different values
+        for the variables in params, with execute.
+        The question must consist only of facts,
+        and the params must be objects in them.
+        '''
+        s, module = self._parse(s)
+        if len(module.code) != 1 or module.code[0].type != 'question':
+            raise TermsSyntaxError('Can only prepare a single question')
+        params = ','.join(params)
+        try:
+            prev = self.session.query(PreparedQuestion).filter_by(name=name).one()
+        except NoResultFound:
+            self._prepared[name] = self._prepare(module, params)
+            self.session.add(PreparedQuestion(name, s, params))
+            self.session.commit()
+        else:
+            if (prev.code, prev.params) != (s, params):
+                raise TermsSyntaxError('There is already a different '
+                                       'question prepared as ' + name)
+        return 'OK'
+
+    def _prepare(self, module, params):
+        params = params.split(',') if params else []
+        if any(s.type != 'fact' for s in module.code[0].facts):
+            raise TermsSyntaxError('Prepared questions can only have facts')
+        q = [self.compile_fact(f) for f in module.code[0].facts]
+        vars = {}
+        for pred in q:
+            self._collect_vars(pred, vars)
+        return params, vars, self.network.prepare(q, params)
+
+    def _collect_vars(self, pred, vars):
+        for o in pred.objects.values():
+            if isinstance(o.value, Predicate):
+                self._collect_vars(o.value, vars)
+            elif o.value.var:
+                vars[o.value.name] = o.value
+
+    def execute(self, name, **values):
+        '''
+        Answer the question prepared as name,
+        given the names (or numbers) of the words for its params.
+        Other processes' prepared questions are built on first use.
+        '''
+        try:
+            params, vars, prepared = self._prepared[name]
+        except KeyError:
+            try:
+                prev = self.session.query(PreparedQuestion).filter_by(name=name).one()
+            except NoResultFound:
+                raise TermsSyntaxError('Unknown prepared question: ' + name)
+            module = self._parse(prev.code)[1]
+            params, vars, prepared = self._prepare(module, prev.params)
+            self._prepared[name] = params, vars, prepared
+        if set(values) != set(params):
+            raise TermsSyntaxError('Expecting values for: ' + ', '.join(params))
+        binds = {}
+        for param in params:
+            var = vars[param]
+            if var.term_type == self.lexicon.number:
+                binds[param] = int(values[param])
+                continue
+            value = self.lexicon.get_term(values[param])
+            if var.bases:
+                correct = are(value, var.bases[0])
+            else:
+                correct = isa(value, var.term_type)
+            if not correct:
+                raise WrongObjectType('Error: word %s for parameter %s is not '
+                                      'the correct type' % (value.name, param))
+            binds[param] = value.id
+        matches = self.network.execute(prepared, binds)
+        if not matches:
+            matches = 'false'
+        elif not matches[0]:
+            matches = 'true'
+        return matches
+
+    def compile(self, ast, stream=False):
         if ast.type == 'definition':
             return self.compile_definition(ast.definition)
         elif ast.type == 'rule':
@@ -589,7 +839,7 @@ class Compiler(object):
         elif ast.type == 'fact-set':
             return self.compile_factset(ast.facts)
         elif ast.type == 'question':
-            return self.compile_question(ast.facts)
+            return self.compile_question(ast.facts, stream=stream)
         elif ast.type == 'removal':
             return self.compile_removal(ast.facts)
         elif ast.type == 'import':
@@ -665,10 +915,12 @@ class Compiler(object):
         # remove premnodes & nodes that have no other rules
         for prem in rule.prems:
             if len(prem.node.prems) == 1:
-                node = prem.node
-                while len(node.parent.children) == 1:
+                node = self.network.nodes.get(prem.node.parent_id)
+                if node is None:  # already removed with another premise
+                    continue
+                while node.parent.parent and len(node.parent.children) == 1:
                     node = node.parent
-                self.session.delete(node)
+                self.network.remove_node(node)
         self.session.delete(rule)
         return 'OK'
 
@@ -734,22 +986,22 @@ class Compiler(object):
             return CondIs(name, base)
 
     def compile_factset(self, facts):
-        for f in facts:
-            pred = self.compile_fact(f)
-            self.network.add_fact(pred)
-            self.session.commit()
+        preds = [self.compile_fact(f) for f in facts]
+        self.network.add_facts(preds)
+        self.session.commit()
         return 'OK'
 
-    def compile_question(self, sentences):
+    def compile_question(self, sentences, stream=False):
+        facts = [s for s in sentences if s.type == 'fact']
+        defs = [s for s in sentences if s.type != 'fact']
+        q = [self.compile_fact(f) for f in facts]
+        if q and not defs:
+            if all(self._is_ground(pred) for pred in q):
+                return 'true' if self.network.ask(*q) else 'false'
+            if stream:
+                return self.network.iquery(*q)
         matches = []
         if sentences:
-            facts, defs = [], []
-            for s in sentences:
-                if s.type == 'fact':
-                    facts.append(s)
-                else:
-                    defs.append(s)
-            q = [self.compile_fact(f) for f in facts]
             matches = self.network.query(*q)
             for defn in defs:
                 if defn.type == 'noun-def':
@@ -765,6 +1017,17 @@ class Compiler(object):
             matches = 'true'
         return matches
 
+    def _is_ground(self, pred):
+        if pred.term_type.var:
+            return False
+        for o in pred.objects.values():
+            if isinstance(o.value, Predicate):
+                if not self._is_ground(o.value):
+                    return False
+            elif o.value.var:
+                return False
+        return True
+
     def compile_removal(self, facts):
         for f in facts:
             pred = self.compile_fact(f)
@@ -803,9 +1066,4 @@ class Runtime(object):
         self.compiler = compiler
 
     def count(self, sen):
-        resp = self.compiler.parse(sen + '?')
-        if resp == 'false':
-            return 0
-        elif resp == 'true':
-            return 1
-        return len(resp)
+        return self.compiler.count(sen + '?')
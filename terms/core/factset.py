@@ -18,14 +18,17 @@
 # If not, see <http://www.gnu.org/licenses/>.
 
 import operator
+import hashlib
+from collections import Counter
 
-from sqlalchemy import Table, Column, Sequence
+from sqlalchemy import Table, Column, Sequence, Index
 from sqlalchemy import ForeignKey, Integer, String, Boolean
-from sqlalchemy.orm import relationship, backref, aliased
-from sqlalchemy import sql
+from sqlalchemy.orm import relationship, backref, aliased, joinedload
+from sqlalchemy import sql, event
+from sqlalchemy.exc import IntegrityError
 
-from terms.core.terms import get_bases
-from terms.core.terms import Base, Term
+from terms.core.terms import term_closure
+from terms.core.terms import Base, Term, Predicate, Object, TObject, PObject
 from terms.core.terms import isa
 from terms.core.utils import Match
 
@@ -37,11 +40,56 @@ class FactSet(object):
     """
     """
 
-    def __init__(self, name, lexicon, config):
+    def __init__(self, name, lexicon, config, unique=False):
         self.name = name
+        self.unique = unique
         self.config = config
         self.session = lexicon.session
         self.lexicon = lexicon
+        self._stats = None
+        self._pending, self._analyzed, self._known = Counter(), {}, set()
+        self._path_ids = None
+        self._compiled = {}
+        event.listen(self.session, 'before_commit', self.flush_stats)
+
+    def sync(self):
+        '''
+        Forget the path statistics,
+        that other processes may have updated,
+        and the interned paths,
+        that a rollback may have undone,
+        along with the new rows not yet written.
+        '''
+        self._stats = None
+        self._pending.clear()
+        self._analyzed.clear()
+        self._path_ids = None
+
+    def upgrade(self):
+        '''
+        Fill in the ids of the paths of the segments, the keys of the facts
+        and the stats of the paths, for a knowledge base made before they were kept,
+        when segments had their paths as strings, in a path column.
+        '''
+        segs = Segment.__table__
+        old_path = sql.literal_column('%s.path' % segs.name)
+        q = sql.select([old_path]).select_from(segs).where(segs.c.path_id==None).distinct()
+        for path, in self.session.execute(q).fetchall():
+            self.get_path_id(tuple(path.split('.')), create=True)
+        paths = SegmentPath.__table__
+        path_id = sql.select([paths.c.id]).where(paths.c.path==old_path).as_scalar()
+        self.session.execute(segs.update().where(segs.c.path_id==None).values(path_id=path_id))
+        if self.unique:
+            q = self.session.query(Fact.id).filter(Fact.factset==self.name, Fact.key==None)
+            fact_ids = [fact_id for fact_id, in q]
+            for start in range(0, len(fact_ids), 500):
+                for fact in self.session.query(Fact).filter(Fact.id.in_(fact_ids[start:start + 500])):
+                    fact.key = self.get_key(fact.pred)
+                self.session.flush()
+        q = sql.select([segs.c.path_id]).select_from(segs.join(Fact.__table__, Fact.id==segs.c.fact_id))
+        q = q.where(Fact.factset==self.name).distinct()
+        self.analyze([path_id for path_id, in self.session.execute(q).fetchall()])
+        self.flush_stats()
 
     def get_paths(self, pred):
         '''
@@ -66,52 +114,389 @@ class FactSet(object):
             else:
                 paths.append(path + (label, '_term'))
 
+    def get_key(self, pred, skip=('since_',)):
+        '''
+        Build a canonical serialization of a (variable free) predicate,
+        leaving out the time it started at,
+        and return a hash of it.
+        '''
+        return hashlib.sha1(self._serialize(pred, skip).encode('utf8')).hexdigest()
+
+    def _serialize(self, pred, skip=()):
+        items = [('' if pred.true else '!') + pred.term_type.name]
+        for label in sorted(pred.objects):
+            if label in skip:
+                continue
+            o = pred.get_object(label)
+            if isinstance(o, Predicate):
+                items.append('{} {}'.format(label, self._serialize(o)))
+            else:
+                items.append('{} {}'.format(label, o.name))
+        return '({})'.format(', '.join(items))
+
+    def get_path_id(self, path, create=False):
+        '''
+        Get the id of the interned path, creating it if asked to.
+        Return None for unknown paths otherwise.
+        Paths missing from the cache are looked for in the db,
+        since they may have been interned by other processes.
+        '''
+        if self._path_ids is None:
+            self._path_ids = dict(self.session.query(SegmentPath.path, SegmentPath.id))
+        path_str = '.'.join(path)
+        path_id = self._path_ids.get(path_str)
+        if path_id is None:
+            path_id = self.session.query(SegmentPath.id).filter(SegmentPath.path==path_str).scalar()
+            if path_id is not None:
+                self._path_ids[path_str] = path_id
+        if path_id is None and create:
+            try:
+                with self.session.begin_nested():
+                    self.session.execute(SegmentPath.__table__.insert(), {'path': path_str})
+            except IntegrityError:
+                pass  # interned meanwhile by another process
+            path_id = self.session.query(SegmentPath.id).filter(SegmentPath.path==path_str).scalar()
+            self._path_ids[path_str] = path_id
+        return path_id
+
     def _get_nclass(self, path):
         ntype = path[-1]
         mapper = Segment.__mapper__
         return mapper.base_mapper.polymorphic_map[ntype].class_
 
     def add_fact(self, pred):
-        logger.info('Adding {!r} to factset {}'.format(pred, self.name))
-        fact = Fact(pred, self.name)
-        paths = self.get_paths(pred)
-        for path in paths:
-            cls = self._get_nclass(path)
-            value = cls.resolve(pred, path, self)
-            cls(fact, value, path)
-        self.session.add(fact)
+        return self.add_facts([pred])[0]
+
+    def add_facts(self, preds):
+        '''
+        Insert the facts for a batch of predicates,
+        emitting the rows for facts, predicates, objects and segments
+        with Core inserts, rather than through the ORM unit of work.
+        Only predicates and facts, that other rows point to,
+        need their ids up front (see insert_rows);
+        objects and segments are inserted with executemany.
+        Return the new facts, loaded through the ORM.
+        '''
+        newpreds, terms = [], []
+        for pred in preds:
+            logger.info('Adding {!r} to factset {}'.format(pred, self.name))
+            self._collect(pred, newpreds, terms, set())
+        for term in terms:
+            self.session.add(term)
         self.session.flush()
-        return fact
+        paths = [self.get_paths(pred) for pred in preds]
+        pred_rows = []
+        for pred in newpreds:
+            pred_rows.append({'true': pred.true,
+                              'type_id': pred.term_type.id,
+                              'rule_id': None})
+        ids = {}
+        for pred, pred_id in zip(newpreds, insert_rows(self.session, Predicate, pred_rows)):
+            ids[id(pred)] = pred_id
+        obj_rows = []
+        for pred in newpreds:
+            for label, o in pred.objects.items():
+                row = {'parent_id': ids[id(pred)],
+                       'label': label,
+                       'term_id': None,
+                       'pred_id': None}
+                if isinstance(o.value, Predicate):
+                    row['otype'] = PObject.__mapper__.polymorphic_identity
+                    row['pred_id'] = o.value.id or ids[id(o.value)]
+                else:
+                    row['otype'] = TObject.__mapper__.polymorphic_identity
+                    row['term_id'] = o.value.id
+                obj_rows.append(row)
+        fact_rows = []
+        for pred in preds:
+            fact_rows.append({'pred_id': pred.id or ids[id(pred)],
+                              'factset': self.name,
+                              'key': self.unique and self.get_key(pred) or None})
+        fact_ids = insert_rows(self.session, Fact, fact_rows)
+        seg_rows = []
+        for pred, fact_id, ppaths in zip(preds, fact_ids, paths):
+            for path in ppaths:
+                cls = self._get_nclass(path)
+                value = cls.resolve(pred, path, self)
+                row = {'fact_id': fact_id,
+                       'path_id': self.get_path_id(path, create=True)}
+                row.update(cls.get_row(value, path))
+                seg_rows.append(row)
+        for table, rows in ((Object.__table__, obj_rows),
+                            (Segment.__table__, seg_rows)):
+            if rows:
+                self.session.execute(table.insert(), rows)
+        self.update_stats(Counter(row['path_id'] for row in seg_rows))
+        facts = {}
+        for start in range(0, len(fact_ids), 500):
+            chunk = fact_ids[start:start + 500]
+            qfacts = self.session.query(Fact).filter(Fact.id.in_(chunk))
+            for fact in qfacts.options(joinedload(Fact.pred)):
+                facts[fact.id] = fact
+        return [facts[fact_id] for fact_id in fact_ids]
+
+    def _collect(self, pred, newpreds, terms, seen):
+        '''
+        Collect the predicates (pred and those nested in it)
+        and the terms that have not yet been persisted.
+        '''
+        if pred.id is not None or id(pred) in seen:
+            return
+        seen.add(id(pred))
+        if pred.term_type.id is None:
+            terms.append(pred.term_type)
+        for o in pred.objects.values():
+            if isinstance(o.value, Predicate):
+                self._collect(o.value, newpreds, terms, seen)
+            elif o.value.id is None:
+                terms.append(o.value)
+        newpreds.append(pred)
+
+    def find_facts(self, preds, chunk=200):
+        '''
+        Look for the facts that match a batch of (variable free) predicates.
+        If the factset keeps keys, this is an indexed lookup on them,
+        and otherwise a single query per chunk of predicates.
+        Return a dict from positions in preds to facts.
+        '''
+        if self.unique:
+            return self._find_keys(preds, chunk)
+        found = {}
+        for start in range(0, len(preds), chunk):
+            queries = []
+            for n, pred in enumerate(preds[start:start + chunk], start):
+                qfacts = self.query_facts(pred, {})
+                queries.append(qfacts.with_entities(sql.literal(n).label('n'), Fact.id.label('fact_id')))
+            qfound = queries[0].union_all(*queries[1:])
+            for n, fact_id in qfound:
+                found[n] = fact_id
+        facts = {}
+        for n, fact_id in found.items():
+            facts[n] = self.session.query(Fact).get(fact_id)
+        return facts
+
+    def _find_keys(self, preds, chunk):
+        keys = {}
+        for n, pred in enumerate(preds):
+            keys.setdefault(self.get_key(pred), []).append(n)
+        found = {}
+        allkeys = list(keys)
+        for start in range(0, len(allkeys), chunk):
+            qfacts = self.session.query(Fact).filter(Fact.factset==self.name,
+                                                   Fact.key.in_(allkeys[start:start + chunk]))
+            for fact in qfacts:
+                for n in keys[fact.key]:
+                    found[n] = fact
+        return found
 
     def add_object_to_fact(self, fact, value, path):
         cls = self._get_nclass(path)
-        segment = cls(fact, value, path)
+        segment = cls(fact, value, self.get_path_id(path, create=True))
         self.session.add(segment)
         fact.pred.add_object(path[-2], value)
 
-    def query_facts(self, pred, taken_vars, with_factset=True):
+    def query_facts(self, pred, taken_vars, with_factset=True, plan=None, params=()):
+        '''
+        Build a query for the facts that match pred.
+        The segments are joined in order of estimated cardinality,
+        and, if plan is a list, the order is recorded in it
+        as (path, value, estimate) tuples.
+        The variables named in params are taken as constants,
+        to be given as bind parameters.
+        '''
         vars = []
         sec_vars = []
         paths = self.get_paths(pred)
         qfacts = self.session.query(Fact)
         if with_factset:
             qfacts = qfacts.filter(Fact.factset==self.name)
+        segs = []
         for path in paths:
             cls = self._get_nclass(path)
             value = cls.resolve(pred, path, self)
+            if getattr(value, 'name', None) in params:
+                value = Param(value.name)
             if value is not None:
-                qfacts = cls.filter_segment(qfacts, value, vars, path)
-        vars.sort(key=lambda x: 1 if getattr(x, 'set_condition', False) else 0)
+                segs.append((self.estimate(path, value), path, cls, value))
+        segs.sort(key=lambda x: x[0])
+        for est, path, cls, value in segs:
+            if plan is not None and not getattr(value, 'var', False):
+                plan.append((path, value, est))
+            qfacts = cls.filter_segment(qfacts, value, vars, path, self)
         for var in vars:
+            var['est'] = self.estimate(var['path'], var['value'])
+        vars.sort(key=lambda x: (1 if getattr(x['value'], 'set_condition', False) else 0, x['est']))
+        for var in vars:
+            if plan is not None:
+                plan.append((var['path'], var['value'], var['est']))
             qfacts = var['cls'].filter_segment_first_var(qfacts, var['value'], var['path'], self, taken_vars, sec_vars)
         for var in sec_vars:
-            qfacts = var['cls'].filter_segment_sec_var(qfacts, var['path'], var['first'])
+            qfacts = var['cls'].filter_segment_sec_var(qfacts, var['path'], var['first'], self)
         return qfacts
 
+    def get_stats(self):
+        '''
+        Get the statistics for the paths in the factset,
+        as a dict of path ids to [rows, distinct values, rows when analyzed].
+        '''
+        if self._stats is None:
+            self._stats = {}
+            stats = PathStat.__table__
+            q = sql.select([stats.c.path_id, stats.c.nrows, stats.c.ndistinct, stats.c.analyzed])
+            for path_id, nrows, ndistinct, analyzed in self.session.execute(q.where(stats.c.factset==self.name)):
+                self._stats[path_id] = [nrows, ndistinct, analyzed]
+            self._known = set(self._stats)
+        return self._stats
+
+    def estimate(self, path, value):
+        '''
+        Estimate the number of segments with path that match value:
+        all of them if value is a variable,
+        and their number over the number of distinct values otherwise.
+        '''
+        stat = self.get_stats().get(self.get_path_id(path))
+        if stat is None:
+            return 0
+        if getattr(value, 'var', False):
+            return stat[0]
+        return stat[0] / (stat[1] or 1)
+
+    def update_stats(self, counts):
+        '''
+        Add counts (a dict of path ids to new segments)
+        to the number of rows of the paths,
+        and recount the distinct values of the paths that have grown
+        by more than the stats_growth factor since they were last counted.
+        The new rows are only written to the db by flush_stats,
+        once per transaction.
+        '''
+        stats = self.get_stats()
+        growth = float(self.config.get('stats_growth', 2))
+        toanalyze = []
+        for path_id, n in counts.items():
+            stats.setdefault(path_id, [0, 0, 0])[0] += n
+            self._pending[path_id] += n
+            if stats[path_id][0] > stats[path_id][2] * growth:
+                toanalyze.append(path_id)
+        if toanalyze:
+            self.analyze(toanalyze)
+
+    def flush_stats(self, session=None):
+        '''
+        Write to the db the rows added to the stats in the transaction,
+        and the recounts of analyze, right before it is committed,
+        so that the rows of the stats, that all tellers update,
+        are locked as briefly as possible, and always in the same order.
+        The row for a path new to the factset is inserted,
+        unless another process has just done it.
+        '''
+        if self.session.transaction.nested:
+            return
+        pending, analyzed = self._pending, self._analyzed
+        self._pending, self._analyzed = Counter(), {}
+        table = PathStat.__table__
+        where = sql.and_(table.c.factset==self.name, table.c.path_id==sql.bindparam('_path_id'))
+        for path_id in sorted(set(pending) | set(analyzed)):
+            n = pending.get(path_id, 0)
+            if path_id in analyzed:
+                nrows, ndistinct = analyzed[path_id]
+                values = {'nrows': nrows + n, 'ndistinct': ndistinct, 'analyzed': nrows}
+            else:
+                values = {'nrows': n, 'ndistinct': 0, 'analyzed': 0}
+            if path_id not in self._known:
+                self._known.add(path_id)
+                try:
+                    with self.session.begin_nested():
+                        row = dict(values, factset=self.name, path_id=path_id)
+                        self.session.execute(table.insert(), row)
+                    continue
+                except IntegrityError:
+                    pass  # inserted meanwhile by another process
+            if path_id not in analyzed:
+                values = {'nrows': table.c.nrows + n}
+            self.session.execute(table.update().where(where).values(**values),
+                                 {'_path_id': path_id})
+
+    def analyze(self, path_ids):
+        '''
+        Recount the rows and distinct values of the paths with path_ids,
+        to be written to the db by flush_stats.
+        '''
+        stats = self.get_stats()
+        segs = Segment.__table__
+        distinct = sum(sql.func.count(sql.distinct(c)) for c in
+                        (segs.c.value, segs.c.term_id, segs.c.int_value, segs.c.verb_id))
+        q = sql.select([segs.c.path_id, sql.func.count(segs.c.id), distinct])
+        q = q.select_from(segs.join(Fact.__table__, Fact.id==segs.c.fact_id))
+        q = q.where(sql.and_(Fact.factset==self.name, segs.c.path_id.in_(path_ids)))
+        for path_id, nrows, ndistinct in self.session.execute(q.group_by(segs.c.path_id)):
+            stats[path_id] = [nrows, ndistinct, nrows]
+            self._pending.pop(path_id, None)
+            self._analyzed[path_id] = (nrows, ndistinct)
+
+    def explain(self, pred):
+        '''
+        Describe how the facts that match pred are queried:
+        the order in which the paths are joined with their estimates,
+        followed by the plan of the database.
+        '''
+        plan = []
+        qfacts = self.query_facts(pred, {}, plan=plan)
+        lines = self.explain_plan(pred, plan)
+        lines.extend(explain_query(self.session, qfacts))
+        return lines
+
+    def explain_plan(self, pred, plan):
+        lines = ['{} in {}:'.format(pred, self.name)]
+        for path, value, est in plan:
+            lines.append('  {} = {} ({:.1f} rows)'.format('.'.join(path), value, est))
+        return lines
+
     def query(self, pred):
         taken_vars = {}
         qfacts = self.query_facts(pred, taken_vars)
-        matches = []
+        return self._get_matches(qfacts, pred, taken_vars)
+
+    def exists(self, pred):
+        '''
+        Whether some fact matches pred,
+        asked with EXISTS, so that the db stops at the first one.
+        '''
+        qfacts = self.query_facts(pred, {})
+        return self.session.query(qfacts.exists()).scalar()
+
+    def prepare(self, pred, params):
+        '''
+        Build the statement for the facts that match pred,
+        with bind parameters for the variables in params
+        that pred has as objects.
+        Return the statement, the variables to take from the facts,
+        and the names of the params used.
+        '''
+        used = set()
+        for path in self.get_paths(pred):
+            self.get_path_id(path, create=True)  # the statement keeps the ids
+            if path[-1] in ('_term', '_num'):
+                value = Segment.resolve(pred, path, self)
+                if value.var and value.name in params:
+                    used.add(value.name)
+        taken_vars = {}
+        qfacts = self.query_facts(pred, taken_vars, params=used)
+        return qfacts.statement, taken_vars, used
+
+    def execute(self, pred, stmt, taken_vars, values):
+        '''
+        Run a statement built by prepare,
+        with values (a dict of param names to ids or numbers).
+        '''
+        qfacts = self.session.query(Fact).from_statement(stmt).params(**values)
+        qfacts = qfacts.execution_options(compiled_cache=self._compiled)
+        return self._get_matches(qfacts, pred, taken_vars)
+
+    def _get_matches(self, qfacts, pred, taken_vars):
+        return list(self._iter_matches(qfacts, pred, taken_vars))
+
+    def _iter_matches(self, qfacts, pred, taken_vars):
         for fact in qfacts:
             match = Match(fact.pred, query=pred)
             match.fact = fact
@@ -122,8 +507,55 @@ class FactSet(object):
                     preds = False
                 value = cls.resolve(fact.pred, path[0], self, preds=preds)
                 match[name] = value
-            matches.append(match)
-        return matches
+            yield match
+
+
+def explain_query(session, qfacts):
+    '''
+    Get the lines of the plan of the database for a query.
+    '''
+    dialect = session.bind.dialect
+    stmt = qfacts.statement.compile(dialect=dialect,
+                                    compile_kwargs={'literal_binds': True})
+    explain = 'EXPLAIN QUERY PLAN ' if dialect.name == 'sqlite' else 'EXPLAIN '
+    return ['  ' + ' | '.join(str(c) for c in row)
+            for row in session.execute(explain + str(stmt))]
+
+
+def reserve_ids(session, cls, n):
+    '''
+    Reserve n primary keys for the table of cls, from its sequence.
+    '''
+    if not n:
+        return []
+    seq = cls.__table__.c.id.default
+    q = sql.select([seq.next_value()]).select_from(sql.func.generate_series(1, n))
+    return [row[0] for row in session.execute(q)]
+
+
+def insert_rows(session, cls, rows):
+    '''
+    Insert rows in the table of cls, and return their primary keys.
+    If the database has sequences, the keys are reserved up front
+    and the rows inserted with executemany;
+    otherwise (sqlite, mysql) the rows are inserted one at a time,
+    taking the keys that the database gives them,
+    so that concurrent inserts never get the same keys.
+    '''
+    if not rows:
+        return []
+    table = cls.__table__
+    if session.bind.dialect.supports_sequences:
+        ids = reserve_ids(session, cls, len(rows))
+        for row, row_id in zip(rows, ids):
+            row['id'] = row_id
+        session.execute(table.insert(), rows)
+        return ids
+    ids = []
+    for row in rows:
+        result = session.execute(table.insert(), row)
+        ids.append(result.inserted_primary_key[0])
+    return ids
 
 
 class Fact(Base):
@@ -135,10 +567,55 @@ class Fact(Base):
                          cascade='all',
                          primaryjoin="Predicate.id==Fact.pred_id")
     factset = Column(String(16))
+    key = Column(String(40))
+
+    __table_args__ = (Index('fact_key_index', 'factset', 'key', unique=True),)
 
-    def __init__(self, pred, name):
+    def __init__(self, pred, name, key=None):
         self.pred = pred
         self.factset = name
+        self.key = key
+
+
+class PathStat(Base):
+    '''
+    Number of segments and of distinct values
+    for a path in a factset.
+    '''
+    __tablename__ = 'pathstats'
+
+    id = Column(Integer, Sequence('pathstat_id_seq'), primary_key=True)
+    factset = Column(String(16))
+    path_id = Column(Integer, ForeignKey('segmentpaths.id'))
+    nrows = Column(Integer)
+    ndistinct = Column(Integer)
+    analyzed = Column(Integer)
+
+    __table_args__ = (Index('pathstat_index', 'factset', 'path_id', unique=True),)
+
+
+class Param(object):
+    '''
+    Placeholder for a constant in a prepared query,
+    given as a bind parameter when the query is run.
+    '''
+    var = False
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return ':' + self.name
+
+
+class SegmentPath(Base):
+    '''
+    Interned paths, referenced by id from segments and path stats.
+    '''
+    __tablename__ = 'segmentpaths'
+
+    id = Column(Integer, Sequence('segmentpath_id_seq'), primary_key=True)
+    path = Column(String, unique=True)
 
 
 class Segment(Base):
@@ -149,24 +626,50 @@ class Segment(Base):
     fact = relationship('Fact',
                          backref='segments',
                          primaryjoin="Fact.id==Segment.fact_id")
-    path = Column(String, index=True)
+    path_id = Column(Integer, ForeignKey('segmentpaths.id'))
 
     ntype = Column(String(5))
     __mapper_args__ = {'polymorphic_on': ntype}
 
-    def __init__(self, fact, value, path):
+    def __init__(self, fact, value, path_id):
         self.fact = fact
         self.value = value
-        self.path = '.'.join(path)
+        self.path_id = path_id
+
+    @classmethod
+    def get_row(cls, value, path):
+        '''
+        Get the column values of a segment for a Core insert.
+        '''
+        return {'ntype': cls.__mapper__.polymorphic_identity,
+                'value': None,
+                'term_id': None,
+                'int_value': None,
+                'verb_id': None}
+
+    @classmethod
+    def get_alias(cls):
+        '''
+        Alias the segments table, rather than the mapped class,
+        so that queries do not filter on the discriminator
+        (the path already determines it),
+        and the joins can be answered from the composite indexes.
+        '''
+        return Segment.__table__.alias()
 
     @classmethod
-    def filter_segment(cls, qfact, value, vars, path):
+    def filter_segment(cls, qfact, value, vars, path, factset):
         if getattr(value, 'var', False):
             vars.append({'cls': cls, 'value': value, 'path': path})
         else:
-            alias = aliased(cls)
-            path_str = '.'.join(path)
-            qfact = qfact.join(alias, Fact.id==alias.fact_id).filter(alias.value==value, alias.path==path_str)
+            alias = cls.get_alias()
+            path_id = factset.get_path_id(path)
+            col = cls.value_column
+            if isinstance(value, Param):
+                const = sql.bindparam(value.name)
+            else:
+                const = cls.get_row(value, path)[col]
+            qfact = qfact.join(alias, Fact.id==alias.c.fact_id).filter(alias.c.path_id==path_id, alias.c[col]==const)
         return qfact
 
     @classmethod
@@ -182,17 +685,19 @@ class Segment(Base):
         return term
 
     @classmethod
-    def filter_segment_sec_var(cls, qfacts, path, salias):
-        alias = aliased(cls)
-        path_str = '.'.join(path)
-        qfacts = qfacts.join(alias, Fact.id==alias.fact_id).filter(alias.path==path_str, alias.term_id==salias.term_id)
+    def filter_segment_sec_var(cls, qfacts, path, salias, factset):
+        alias = cls.get_alias()
+        path_id = factset.get_path_id(path)
+        col = cls.value_column
+        qfacts = qfacts.join(alias, Fact.id==alias.c.fact_id).filter(alias.c.path_id==path_id, alias.c[col]==salias.c[col])
         return qfacts
 
 
 class NegSegment(Segment):
 
     __mapper_args__ = {'polymorphic_identity': '_neg'}
-    value = Column(Boolean, index=True)
+    value = Column(Boolean)
+    value_column = 'value'
 
     @classmethod
     def resolve(cls, pred, path, factset, preds=False):
@@ -203,37 +708,51 @@ class NegSegment(Segment):
         except AttributeError:
             return None
 
+    @classmethod
+    def get_row(cls, value, path):
+        row = super(NegSegment, cls).get_row(value, path)
+        row['value'] = value
+        return row
+
 
 class TermSegment(Segment):
 
     __mapper_args__ = {'polymorphic_identity': '_term'}
-    term_id = Column(Integer, ForeignKey('terms.id'), index=True)
+    term_id = Column(Integer, ForeignKey('terms.id'))
     value = relationship('Term',
                          primaryjoin="Term.id==TermSegment.term_id")
+    value_column = 'term_id'
+
+    @classmethod
+    def get_row(cls, value, path):
+        row = super(TermSegment, cls).get_row(value, path)
+        row['term_id'] = value.id
+        return row
 
     @classmethod
     def filter_segment_first_var(cls, qfacts, value, path, factset, taken_vars, sec_vars):
-        salias = aliased(cls)
+        salias = cls.get_alias()
         talias = aliased(Term)
         if value.name in taken_vars:
             sec_vars.append({'cls': cls, 'path': path, 'first': taken_vars[value.name][1]})
             return qfacts
         else:
             taken_vars[value.name] = (path, salias)
-        path_str = '.'.join(path)
+        path_id = factset.get_path_id(path)
+        closure = term_closure.alias()
+        qfacts = qfacts.join(salias, Fact.id==salias.c.fact_id).filter(salias.c.path_id==path_id)
         if value.bases:
-            sbases = [b.id for b in factset.lexicon.get_subterms(value.bases[0])]
-            qfacts = qfacts.join(salias, Fact.id==salias.fact_id).filter(salias.path==path_str).join(talias, salias.term_id==talias.id).filter(talias.id.in_(sbases))
+            qfacts = qfacts.join(closure, salias.c.term_id==closure.c.descendant_id).filter(closure.c.ancestor_id==value.bases[0].id)
         else:
-            sbases = [b.id for b in factset.lexicon.get_subterms(value.term_type)]
-            qfacts = qfacts.join(salias, Fact.id==salias.fact_id).filter(salias.path==path_str).join(talias, salias.term_id==talias.id).filter(talias.type_id.in_(sbases))
+            qfacts = qfacts.join(talias, salias.c.term_id==talias.id).join(closure, talias.type_id==closure.c.descendant_id).filter(closure.c.ancestor_id==value.term_type.id)
         return qfacts
 
 
 class NumberSegment(Segment):
 
     __mapper_args__ = {'polymorphic_identity': '_num'}
-    int_value = Column(Integer, index=True)
+    int_value = Column(Integer)
+    value_column = 'int_value'
 
     binopers = {
         '|': sql.or_,
@@ -255,12 +774,12 @@ class NumberSegment(Segment):
         '-': operator.neg,
     }
 
-    def __init__(self, fact, value, path):
+    def __init__(self, fact, value, path_id):
         self.fact = fact
         if getattr(value, 'name', False):
             value = int(value.name)
         self.value = value
-        self.path = '.'.join(path)
+        self.path_id = path_id
 
     @property
     def value(self):
@@ -271,21 +790,22 @@ class NumberSegment(Segment):
         self.int_value = val
 
     @classmethod
-    def filter_segment(cls, qfact, value, vars, path):
-        if getattr(value, 'var', False):
-            vars.append({'cls': cls, 'value': value, 'path': path})
-        else:
-            alias = aliased(cls)
-            path_str = '.'.join(path)
-            qfact = qfact.join(alias, Fact.id==alias.fact_id).filter(alias.int_value==int(value.name), alias.path==path_str)
-        return qfact
+    def get_row(cls, value, path):
+        row = super(NumberSegment, cls).get_row(value, path)
+        if getattr(value, 'name', False):
+            value = int(value.name)
+        row['int_value'] = value
+        return row
 
     @classmethod
     def filter_segment_first_var(cls, qfacts, value, path, factset, taken_vars, sec_vars):
-        alias = aliased(cls)
+        alias = cls.get_alias()
+        if value.name in taken_vars:
+            sec_vars.append({'cls': cls, 'path': path, 'first': taken_vars[value.name][1]})
+            return qfacts
         taken_vars[value.name] = (path, alias)
-        path_str = '.'.join(path)
-        qfacts = qfacts.join(alias, Fact.id==alias.fact_id).filter(alias.path==path_str)
+        path_id = factset.get_path_id(path)
+        qfacts = qfacts.join(alias, Fact.id==alias.c.fact_id).filter(alias.c.path_id==path_id)
         if getattr(value, 'set_condition', False):
             condition = cls.compile_condition(value.set_condition, taken_vars)
             qfacts = qfacts.filter(condition)
@@ -306,16 +826,23 @@ class NumberSegment(Segment):
     def compile_vnum(cls, vnum, taken_vars):
         if vnum.var:
             alias = taken_vars[vnum.val][1]
-            return getattr(alias, 'int_value')
+            return alias.c.int_value
         return int(vnum.val)
 
 
 class VerbSegment(Segment):
 
     __mapper_args__ = {'polymorphic_identity': '_verb'}
-    verb_id = Column(Integer, ForeignKey('terms.id'), index=True)
+    verb_id = Column(Integer, ForeignKey('terms.id'))
     value = relationship('Term',
                          primaryjoin="Term.id==VerbSegment.verb_id")
+    value_column = 'verb_id'
+
+    @classmethod
+    def get_row(cls, value, path):
+        row = super(VerbSegment, cls).get_row(value, path)
+        row['verb_id'] = value.id
+        return row
 
     @classmethod
     def resolve(cls, term, path, factset, preds=False):
@@ -327,27 +854,24 @@ class VerbSegment(Segment):
 
     @classmethod
     def filter_segment_first_var(cls, qfacts, value, path, factset, taken_vars, sec_vars):
-        salias = aliased(cls)
-        talias = aliased(Term)
+        salias = cls.get_alias()
         if value.name in taken_vars:
             sec_vars.append({'cls': cls, 'path': path, 'first': taken_vars[value.name][1]})
             return qfacts
         else:
             taken_vars[value.name] = (path, salias)
-#        if value.name == 'Exists1':
-#            import pdb;pdb.set_trace()
         if isa(value, factset.lexicon.verb):
-            sbases = factset.lexicon.get_subterms(get_bases(value)[0])
+            ancestor = value.bases[0]
         elif isa(value, factset.lexicon.exist):
-            sbases = factset.lexicon.get_subterms(value.term_type)
-        sbases = [b.id for b in sbases]
-        path_str = '.'.join(path)
-        qfacts = qfacts.join(salias, Fact.id==salias.fact_id).filter(salias.path==path_str).join(talias, salias.verb_id==talias.id).filter(talias.id.in_(sbases))
+            ancestor = value.term_type
+        path_id = factset.get_path_id(path)
+        closure = term_closure.alias()
+        qfacts = qfacts.join(salias, Fact.id==salias.c.fact_id).filter(salias.c.path_id==path_id).join(closure, salias.c.verb_id==closure.c.descendant_id).filter(closure.c.ancestor_id==ancestor.id)
         return qfacts
 
-    @classmethod
-    def filter_segment_sec_var(cls, qfacts, path, salias):
-        alias = aliased(cls)
-        path_str = '.'.join(path)
-        qfacts = qfacts.join(alias, Fact.id==alias.fact_id).filter(alias.path==path_str, alias.verb_id==salias.verb_id)
-        return qfacts
+
+# composite indexes, so that the joins in FactSet.query_facts can be index-only
+for name, col in (('neg', 'value'), ('term', 'term_id'),
+                  ('num', 'int_value'), ('verb', 'verb_id')):
+    Index('segment_{}_index'.format(name), Segment.__table__.c.path_id,
+          Segment.__table__.c[col], Segment.__table__.c.fact_id)
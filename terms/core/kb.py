@@ -3,6 +3,7 @@ import sys
 import time
 import json
 import multiprocessing as mp
+from types import GeneratorType
 from multiprocessing import Process, JoinableQueue, Lock
 from multiprocessing.connection import Listener
 from threading import Thread
@@ -24,6 +25,17 @@ from terms.core.exceptions import ImportProblems, DuplicateWord
 import logging
 logger = logging.getLogger(__name__)
 
+# messages sent back for the errors in the requests
+ERRORS = (
+    (TermNotFound, 'Unknown word: {}'),
+    (TermsSyntaxError, 'Terms syntax error: {}'),
+    (IllegalLabel, 'Error: labels cannot contain underscores: {}'),
+    (WrongLabel, '{}'),
+    (WrongObjectType, '{}'),
+    (ImportProblems, '{}'),
+    (DuplicateWord, '{}'),
+)
+
 
 class TermsJSONEncoder(json.JSONEncoder):
 
@@ -41,9 +53,14 @@ class Teller(Process):
         self.config = config
         self.session_factory = session_factory
         self.teller_queue = teller_queue
+        self.session = None
         self.compiler = None
+        self.exec_globals_id = 0
 
     def run(self):
+        self.session = self.session_factory()
+        self.compiler = Compiler(self.session, self.config)
+        register_exec_global(Runtime(self.compiler), name='runtime')
         for client in iter(self.teller_queue.get, None):
             totell = []
             try:
@@ -54,10 +71,9 @@ class Teller(Process):
                 self.teller_queue.task_done()
                 continue
             totell = '\n'.join(totell)
-            session = self.session_factory()
-            self.compiler = Compiler(session, self.config)
-            register_exec_global(Runtime(self.compiler), name='runtime')
-            load_exec_globals(session)
+            self.compiler.network.sync()
+            self.exec_globals_id = load_exec_globals(self.session,
+                                                     self.exec_globals_id)
             if totell.startswith('lexicon:'):
                 try:
                     resp = self._from_lexicon(totell)
@@ -68,43 +84,127 @@ class Teller(Process):
             else:
                 self.compiler.network.pipe = client
                 try:
-                    resp = self.compiler.parse(totell)
-                except TermNotFound as e:
-                    session.rollback()
-                    resp = 'Unknown word: ' + e.args[0]
-                except TermsSyntaxError as e:
-                    session.rollback()
-                    resp = 'Terms syntax error: ' + e.args[0]
-                except WrongLabel as e:
-                    session.rollback()
-                    resp = e.args[0]
-                except IllegalLabel as e:
-                    session.rollback()
-                    resp = 'Error: labels cannot contain underscores: %s' % e.args[0]
-                except WrongObjectType as e:
-                    session.rollback()
-                    resp = e.args[0]
-                except ImportProblems as e:
-                    session.rollback()
-                    resp = e.args[0]
-                except DuplicateWord as e:
-                    session.rollback()
-                    resp = e.args[0]
+                    if totell.startswith('compiler:facts:'):
+                        resp = self.compiler.parse_facts(totell[15:])
+                    elif totell.startswith('compiler:explain:'):
+                        resp = self.compiler.explain(totell[17:])
+                    elif totell.startswith('compiler:prepare:'):
+                        resp = self._prepare(totell[17:])
+                    elif totell.startswith('compiler:execute:'):
+                        resp = self._execute(totell[17:])
+                    elif totell.startswith('compiler:count:'):
+                        resp = self.compiler.count(totell[15:])
+                    elif totell.startswith('compiler:page:'):
+                        resp = self._page(totell[14:])
+                    else:
+                        resp = self.compiler.parse(totell, stream=True)
+                except Exception as e:
+                    resp = self._error(e)
                 self.compiler.network.pipe = None
-                resp = json.dumps(resp, cls=TermsJSONEncoder)
+                if not isinstance(resp, GeneratorType):
+                    resp = json.dumps(resp, cls=TermsJSONEncoder)
             try:
-                client.send_bytes(str(resp).encode('utf8'))
-            except BrokenPipeError:
+                if isinstance(resp, GeneratorType):
+                    self._send_matches(client, resp)
+                else:
+                    client.send_bytes(str(resp).encode('utf8'))
+            except (BrokenPipeError, ConnectionResetError, EOFError):
                 pass
             else:
                 client.send_bytes(b'END')
             client.close()
-            session.close()  # XXX needed?
-            self.compliler = None
+            self.session.commit()
             self.teller_queue.task_done()  # abyss
+        self.session.close()
         self.teller_queue.task_done()
         self.teller_queue.close()
 
+    def _send_matches(self, client, matches):
+        '''
+        Send the matches for a question as json lists
+        of at most stream_chunk_size matches,
+        or as "true" or "false" if there are no variables or no matches.
+        The client can stop the stream sending CANCEL between chunks.
+        An error while getting the matches ends the stream
+        with the message for it.
+        '''
+        size = int(self.config.get('stream_chunk_size', 1000))
+        try:
+            first = next(matches, None)
+            if first is None or not first:
+                matches.close()
+                resp = 'false' if first is None else 'true'
+                client.send_bytes(json.dumps(resp).encode('utf8'))
+                return
+            chunk = [first]
+            for match in matches:
+                if len(chunk) == size:
+                    client.send_bytes(json.dumps(chunk, cls=TermsJSONEncoder).encode('utf8'))
+                    chunk = []
+                    if client.poll() and client.recv_bytes() == b'CANCEL':
+                        matches.close()
+                        return
+                chunk.append(match)
+            client.send_bytes(json.dumps(chunk, cls=TermsJSONEncoder).encode('utf8'))
+        except (BrokenPipeError, ConnectionResetError, EOFError):
+            raise
+        except Exception as e:
+            matches.close()
+            client.send_bytes(json.dumps(self._error(e)).encode('utf8'))
+
+    def _error(self, e):
+        '''
+        Roll back the request that raised e,
+        and get the message to send back for it.
+        Unexpected errors are logged with their traceback.
+        '''
+        self._rollback()
+        for cls, msg in ERRORS:
+            if isinstance(e, cls):
+                return msg.format(e.args[0])
+        logger.exception('Error serving a request')
+        return 'Error: {!r}'.format(e)
+
+    def _rollback(self):
+        '''
+        Discard the current transaction,
+        and with it whatever the compiler has cached from it.
+        '''
+        self.session.rollback()
+        self.compiler.network.mark_stale()
+
+    def _prepare(self, totell):
+        try:
+            name, params, question = totell.split(':', 2)
+        except ValueError:
+            raise TermsSyntaxError('Expecting name:params:question')
+        params = [p.strip() for p in params.split(',') if p.strip()]
+        return self.compiler.prepare(name.strip(), question, params)
+
+    def _execute(self, totell):
+        try:
+            name, values = totell.split(':', 1)
+            values = json.loads(values or '{}')
+        except ValueError:
+            raise TermsSyntaxError('Expecting name:json object of values')
+        return self.compiler.execute(name.strip(), **values)
+
+    def _page(self, totell):
+        try:
+            options, question = totell.split(':', 1)
+            options = dict(o.strip().split('=', 1)
+                           for o in options.split(',') if o.strip())
+            limit = options.pop('limit', None)
+            limit = int(limit) if limit is not None else None
+            offset = options.pop('offset', None)
+            offset = int(offset) if offset is not None else None
+        except ValueError:
+            raise TermsSyntaxError('Expecting limit=n,offset=n,order=var:question')
+        order = options.pop('order', None)
+        if options or (limit or 0) < 0 or (offset or 0) < 0:
+            raise TermsSyntaxError('Expecting limit=n,offset=n,order=var:question')
+        return self.compiler.page(question, limit=limit, offset=offset, order=order)
+
     def _from_lexicon(self, totell):
         q = totell.split(':')
         ttype = self.compiler.lexicon.get_term(q[2])
@@ -197,6 +297,7 @@ class Ticker(Thread):
         while self.ticking:
             self.time_lock.acquire()
             self.teller_queue.join()
+            self.compiler.network.sync()
             pred = Predicate(True, self.compiler.lexicon.vtime,
                              subj=self.compiler.lexicon.now_term)
             try:
@@ -205,7 +306,7 @@ class Ticker(Thread):
             except NoResultFound:
                 pass
             else:
-                self.session.delete(fact)
+                self.compiler.network.delete_fact(fact)
                 self.session.commit()
             self.compiler.network.passtime()
             pred = Predicate(True, self.compiler.lexicon.vtime,
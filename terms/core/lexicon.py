@@ -17,18 +17,37 @@
 # along with any part of the terms project.
 # If not, see <http://www.gnu.org/licenses/>.
 
+from sqlalchemy import sql
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
 from terms.core import exceptions
 from terms.core import patterns
-from terms.core.terms import Term, Predicate, isa, are, Time
+from terms.core.terms import Term, Predicate, isa, are, Time, Generation
+from terms.core.terms import get_bases, term_closure, term_to_base, term_intervals
+from terms.core.utils import LRUCache
 
 
 class Lexicon(object):
 
+    # width of the interval of the root of the taxonomy
+    span = 2 ** 62
+    # a new subterm takes this fraction of the room left in its base
+    share = 16
+    # room per term that a subtree must have to be labelled anew
+    # when a new subterm does not fit, rather than its base's subtree
+    room = share ** 2
+
     def __init__(self, session, config):
         self.config = config
         self.session = session
+        self._term_cache = LRUCache(int(config.get('term_cache_size', 10000)))
+        self._number_cache = LRUCache(int(config.get('term_cache_size', 10000)))
+        self.generation = Generation.get(session)[0]
+        self.bumps = 0
+        if int(config.get('term_cache_preload', 1)):
+            self.preload()
         self.word = self.get_term('word')
         self.verb = self.get_term('verb')
         self.noun = self.get_term('noun')
@@ -43,7 +62,85 @@ class Lexicon(object):
         self.finish = self.get_term('finish')
         self.time = self.session.query(Time).one()
         self.now_term = self.make_term(str(0 + self.time.now), self.number)
-        self._term_cache = {}
+
+    def preload(self):
+        '''
+        Load into the term cache, with a single query,
+        as many non variable terms as it can hold,
+        the oldest (and most general) first.
+        '''
+        q = self.session.query(Term).filter(sql.or_(Term.var==False, Term.var==None))
+        q = q.order_by(Term.id)
+        if self._term_cache.size:
+            q = q.limit(self._term_cache.size)
+        for term in q:
+            self._term_cache[term.name] = term
+
+    def sync(self, generation):
+        '''
+        Given the current lexicon generation in the db,
+        drop the cached terms that have been changed
+        by someone else since the last sync
+        (all of them if what changed is not known),
+        and catch up with the time.
+        '''
+        if generation != self.generation + self.bumps:
+            changed = Generation.changes(self.session, 'lexicon',
+                                         self.generation, generation)
+            if changed is None:
+                self.invalidate()
+            else:
+                self.evict(changed)
+        self.generation = generation
+        self.bumps = 0
+        self.session.refresh(self.time)
+        self.now_term = self.make_term(str(0 + self.time.now), self.number)
+
+    def mark_stale(self):
+        '''
+        Make the next sync drop all caches,
+        and forget the number terms now,
+        since the rollback that makes them stale
+        may have undone their insertion.
+        '''
+        self.generation = -1
+        self.bumps = 0
+        self._number_cache.clear()
+
+    def invalidate(self):
+        '''
+        Empty the term cache, and the taxonomy caches of the terms
+        in the session, which are expired to reload their intervals.
+        '''
+        self._term_cache.clear()
+        self._number_cache.clear()
+        for obj in list(self.session.identity_map.values()):
+            if isinstance(obj, Term):
+                obj._sup_cache = obj._sub_cache = obj._intervals = None
+                self.session.expire(obj)
+        if int(self.config.get('term_cache_preload', 1)):
+            self.preload()
+
+    def evict(self, term_ids):
+        '''
+        Expire the terms with term_ids, that have been added or labelled anew
+        by someone else, and their ancestors, whose subterms have changed,
+        if they are in the session, and empty their taxonomy caches.
+        '''
+        ids, term_ids = set(term_ids), list(term_ids)
+        tc = term_closure.c
+        for start in range(0, len(term_ids), 500):
+            q = sql.select([tc.ancestor_id]).where(tc.descendant_id.in_(term_ids[start:start + 500]))
+            ids.update(row[0] for row in self.session.execute(q))
+        for term_id in ids:
+            term = self.session.identity_map.get(identity_key(Term, term_id))
+            if term is not None:
+                term._sub_cache = term._intervals = None
+                self.session.expire(term)
+
+    def _bump(self, term_ids):
+        Generation.bump(self.session, 'lexicon', term_ids)
+        self.bumps += 1
 
     @classmethod
     def initialize(cls, session):
@@ -54,6 +151,7 @@ class Lexicon(object):
         session.add(word)
         session.commit()
         word.term_type = word
+        word.lft, word.rgt, word.free = 0, cls.span - 1, 1
         session.commit()
         verb = Term('verb', ttype=word, bases=(word,))
         session.add(verb)
@@ -82,36 +180,57 @@ class Lexicon(object):
         finish = Term('finish', ttype=verb, bases=(occur,),
                       objs={'subj': thing, 'what': exist})
         session.add(finish)
+        for term in (word, verb, noun, number, exist, endure, exclusive_endure,
+                     occur, happen, time, thing, finish):
+            cls.add_to_taxonomy(session, term)
         time = Time()
         session.add(time)
+        session.add(Generation())
         session.commit()
 
+    @classmethod
+    def upgrade(cls, session):
+        '''
+        Fill in the generation counters, the closure table and the labels
+        of the taxonomy of a knowledge base made before they were kept,
+        adding the terms to the taxonomy in the order they were made in.
+        '''
+        if session.query(Generation).first() is None:
+            session.add(Generation())
+        word = session.query(Term).filter_by(name='word').one()
+        if word.lft is not None:
+            return
+        word.lft, word.rgt, word.free = 0, cls.span - 1, 1
+        q = session.query(Term.id).filter(sql.or_(Term.var==False, Term.var==None),
+                                          sql.or_(Term.number==False, Term.number==None))
+        for term_id, in q.order_by(Term.id).all():
+            cls.add_to_taxonomy(session, session.query(Term).get(term_id))
+
     def get_term(self, name):
         '''
         Given a name (string), get a Term from the database.
         The Term must exist.
         '''
-        cache = getattr(self, '_term_cache', None)
-        if cache is not None:
-            if name in cache:
-                return cache[name]
-        else:
-            self._term_cache = {}
+        if name in self._term_cache:
+            return self._term_cache[name]
         try:
-            return self.session.query(Term).filter_by(name=name).one()
+            term = self.session.query(Term).filter_by(name=name).one()
         except MultipleResultsFound:
             raise exceptions.TermRepeated(name)
         except NoResultFound:
             raise exceptions.TermNotFound(name)
+        if not term.var:  # variables go away with their rules
+            self._term_cache[name] = term
+        return term
 
     def get_terms(self, term_type):
         '''
         Get all terms of type term_type.
         The term_type must exist.
         '''
-        types = self.get_subterms(term_type)
-        type_ids = [t.id for t in types if t is not self.number]
-        return self.session.query(Term).filter(Term.type_id.in_(type_ids)).all()
+        q = self.session.query(Term).join(term_closure, Term.type_id==term_closure.c.descendant_id)
+        q = q.filter(term_closure.c.ancestor_id==term_type.id, Term.type_id!=self.number.id)
+        return q.all()
 
     def make_term(self, name, term_type, **objs):
         '''
@@ -158,19 +277,158 @@ class Lexicon(object):
                 return self._make_verb(name, bases=super_terms, objs=objs)
 
     def add_term(self, name, term_type, **objs):
-        term = self.make_term(name, term_type, **objs)
+        try:
+            term = self.get_term(name)
+        except exceptions.TermNotFound:
+            term = self.make_term(name, term_type, **objs)
+            if isinstance(term, Term):
+                changed = self.add_to_taxonomy(self.session, term)
+                term.add_to_caches()
+                self._bump(changed)
         self.session.add(term)
-        term.purge_cache(self)
         self._term_cache[name] = term
         return term
 
     def add_subterm(self, name, super_terms, **objs):
-        term = self.make_subterm(name, super_terms, **objs)
+        try:
+            term = self.get_term(name)
+        except exceptions.TermNotFound:
+            term = self.make_subterm(name, super_terms, **objs)
+            changed = self.add_to_taxonomy(self.session, term)
+            term.add_to_caches()
+            self._bump(changed)
         self.session.add(term)
-        term.purge_cache(self)
         self._term_cache[name] = term
         return term
 
+    @classmethod
+    def add_to_taxonomy(cls, session, term):
+        '''
+        Add a new term to the session,
+        to the closure table, as descendant of itself
+        and of its bases and their ancestors,
+        and label it with an interval within its first base.
+        Return the ids of the new term and of the terms labelled anew.
+        '''
+        session.add(term)
+        session.flush()
+        ancestors = set([term])
+        for base in term.bases:
+            ancestors.add(base)
+            ancestors.update(get_bases(base))
+        rows = [{'ancestor_id': a.id, 'descendant_id': term.id} for a in ancestors]
+        session.execute(term_closure.insert(), rows)
+        return {term.id} | cls.label_term(session, term)
+
+    @classmethod
+    def label_term(cls, session, term):
+        '''
+        Give a new term an interval within the free part of
+        the interval of its first base (the one with the lowest id),
+        and add it to the intervals of the ancestors
+        that it only has through its other bases.
+        If there is no room left, label anew the subtree around it.
+        Return the ids of the terms labelled anew.
+        '''
+        bases = sorted(term.bases, key=lambda b: b.id)
+        changed = set()
+        if not bases or bases[0].lft is None:
+            return changed
+        parent = bases[0]
+        session.refresh(parent, ['lft', 'rgt', 'free'], with_for_update=True)
+        width = (parent.rgt - parent.free + 1) // cls.share
+        if width < 2:
+            changed = cls.relabel(session, term, parent)
+        else:
+            term.lft = parent.free
+            term.rgt = parent.free + width - 1
+            term.free = term.lft + 1
+            parent.free = term.rgt + 1
+        others = set()
+        for base in bases[1:]:
+            others.add(base)
+            others.update(get_bases(base))
+        others -= set((parent,) + get_bases(parent))
+        if others:
+            rows = [{'term_id': a.id, 'lft': term.lft, 'rgt': term.rgt} for a in others]
+            session.execute(term_intervals.insert(), rows)
+            for a in others:
+                if getattr(a, '_intervals', None) is not None:
+                    a._intervals.append((term.lft, term.rgt))
+        session.flush()
+        return changed
+
+    @classmethod
+    def relabel(cls, session, term, parent):
+        '''
+        Label anew, together with the new term under parent,
+        the subterms (in the spanning tree) of the closest ancestor
+        of the term whose interval has room for them,
+        or of the root of the taxonomy if none has.
+        Each interval is sized after the number of terms under it,
+        leaving in each the same free room for new subterms.
+        Return the ids of the terms labelled anew,
+        and of those with intervals among them.
+        '''
+        session.flush()
+        terms = Term.__table__
+        tb = term_to_base.c
+        q = sql.select([terms.c.id, terms.c.lft, terms.c.rgt])
+        q = q.where(sql.and_(terms.c.lft <= parent.lft, terms.c.rgt >= parent.lft))
+        for top, top_lft, top_rgt in session.execute(q.order_by(terms.c.lft.desc())):
+            in_top = terms.c.lft.between(top_lft, top_rgt)
+            q = sql.select([sql.func.count()]).select_from(terms).where(in_top)
+            if (top_rgt - top_lft + 1) // (session.execute(q).scalar() + 1) >= cls.room:
+                break
+        q = sql.select([terms.c.id, terms.c.lft]).where(in_top)
+        old = dict(tuple(row) for row in session.execute(q))
+        old[term.id] = None
+        bases = {}
+        q = sql.select([tb.term_id, tb.base_id]).select_from(
+            term_to_base.join(terms, terms.c.id==tb.term_id))
+        q = q.where(sql.or_(in_top, terms.c.id==term.id))
+        for term_id, base_id in session.execute(q):
+            bases.setdefault(term_id, []).append(base_id)
+        children = {}
+        for term_id, base_ids in bases.items():
+            if term_id != top:
+                children.setdefault(min(base_ids), []).append(term_id)
+        order = [top]
+        for term_id in order:
+            order.extend(sorted(children.get(term_id, ())))
+        need = {}
+        for term_id in reversed(order):
+            need[term_id] = 1 + sum(need[c] for c in children.get(term_id, ()))
+        scale = (top_rgt - top_lft + 1) // need[top]
+        labels = {top: [top_lft, top_lft + need[top] * scale - 1, top_lft + 1]}
+        for term_id in order:
+            label = labels[term_id]
+            for c in sorted(children.get(term_id, ())):
+                labels[c] = [label[2], label[2] + need[c] * scale - 1, label[2] + 1]
+                label[2] += need[c] * scale
+        labels[top][1] = top_rgt
+        ti = term_intervals.c
+        in_top = ti.lft.between(top_lft, top_rgt)
+        by_lft = dict((lft, term_id) for term_id, lft in old.items())
+        intervals = []
+        for term_id, lft, rgt in session.execute(sql.select([ti.term_id, ti.lft, ti.rgt]).where(in_top)):
+            label = labels[by_lft[lft]]
+            intervals.append({'term_id': term_id, 'lft': label[0], 'rgt': label[1]})
+        q = terms.update().where(terms.c.id==sql.bindparam('_id'))
+        q = q.values(lft=sql.bindparam('_lft'), rgt=sql.bindparam('_rgt'), free=sql.bindparam('_free'))
+        session.execute(q, [{'_id': t, '_lft': l[0], '_rgt': l[1], '_free': l[2]}
+                            for t, l in labels.items()])
+        session.execute(term_intervals.delete().where(in_top))
+        if intervals:
+            session.execute(term_intervals.insert(), intervals)
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, Term):
+                if obj.id in labels:
+                    for attr, val in zip(('lft', 'rgt', 'free'), labels[obj.id]):
+                        set_committed_value(obj, attr, val)
+                obj._intervals = None
+        return set(labels) | {i['term_id'] for i in intervals}
+
     def get_subterms(self, term):
         cache = getattr(term, '_sub_cache', None)
         if cache is not None:
@@ -182,9 +440,12 @@ class Lexicon(object):
                 term = self.get_term(m.group(1).lower())
             else:
                 return ()
-        subtypes = set([term])
-        self._recurse_subterms(term, subtypes)
-        subterms = tuple(subtypes)
+        q = self.session.query(Term).join(term_closure, Term.id==term_closure.c.descendant_id)
+        subterms = tuple(q.filter(term_closure.c.ancestor_id==term.id))
+        if not subterms:  # not in the closure table
+            subtypes = set([term])
+            self._recurse_subterms(term, subtypes)
+            subterms = tuple(subtypes)
         term._sub_cache = subterms
         return subterms
 
@@ -261,5 +522,39 @@ class Lexicon(object):
         number.number = True
         return number
 
+    def number_value(self, term):
+        '''
+        Get the value of a number term, or None for other terms.
+        The value is kept in the term after the first time.
+        '''
+        try:
+            return term._number_value
+        except AttributeError:
+            pass
+        value = None
+        if getattr(term, 'number', False):
+            try:
+                value = int(term.name)
+            except ValueError:
+                value = float(term.name)
+        term._number_value = value
+        return value
+
+    def number_term(self, value):
+        '''
+        Get the term for a number, as make_term would,
+        caching it by value once it is in the db,
+        so that no two new terms are made for the same number.
+        '''
+        key = (type(value), value)
+        try:
+            return self._number_cache[key]
+        except KeyError:
+            pass
+        term = self.make_term(str(0 + value), self.number)
+        if term.id is not None:
+            self._number_cache[key] = term
+        return term
+
     def make_pred(self, true, verb_, **objs):
         return Predicate(true, verb_, **objs)
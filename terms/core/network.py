@@ -18,37 +18,145 @@
 # If not, see <http://www.gnu.org/licenses/>.
 
 import time
-import functools
+import itertools
 
 from sqlalchemy import Column, Sequence, Index
 from sqlalchemy import ForeignKey, Integer, String, Boolean
-from sqlalchemy.orm import relationship, backref, aliased
+from sqlalchemy import sql, and_, true, func
+from sqlalchemy.orm import relationship, backref, with_polymorphic
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy.exc import InvalidRequestError
 
 from terms.core import localdata
 from terms.core.terms import isa, are, get_bases
-from terms.core.terms import Base, Term, term_to_base, Predicate
+from terms.core.terms import Base, Term, term_to_base, Predicate, Generation
+from terms.core.terms import Object
 from terms.core.lexicon import Lexicon
-from terms.core.factset import FactSet
+from terms.core.factset import FactSet, Fact, VerbSegment, NumberSegment
+from terms.core.factset import explain_query
 from terms.core import exceptions
-from terms.core.utils import Match, merge_submatches
+from terms.core.utils import Match, Agenda, merge_submatches, binding_key
 
 from logging import getLogger
 logger = getLogger(__name__)
 
 
+def is_pred_var(name, cls):
+    '''
+    Whether the variable name, for a segment of class cls,
+    is for whole predicates, rather than for their verbs.
+    '''
+    return cls is VerbSegment and 'Verb' not in name[1:]
+
+
 class Network(object):
 
     def __init__(self, session, config):
         self.session = session
         self.config = config
-        self.activations = []
-        self.root = self.session.query(RootNode).one()
+        self.activations = Agenda(config.get('agenda_strategy', 'fifo'))
         self.lexicon = Lexicon(session, config)
-        self.present = FactSet('present', self.lexicon, config)
+        self.generation = Generation.get(session)[1]
+        self.bumps = 0
+        self._changed_nodes = set()
+        self._matches_bumped, self._matches_txn = set(), None
+        self.root = self._load_nodes()
+        self.memories = {}
+        self.programs, self.rule_programs = {}, {}
+        self.present = FactSet('present', self.lexicon, config, unique=True)
         self.past = FactSet('past', self.lexicon, config)
         self.pipe = None
+        # CTEs are only inlined (and can be asked not to be) from postgresql 12
+        dialect = session.get_bind().dialect
+        self.materialize = (dialect.name == 'postgresql'
+                            and dialect.server_version_info >= (12,))
+
+    def sync(self):
+        '''
+        Check the generation counters in the db,
+        and drop whatever is cached of the lexicon or of the network
+        that has been changed by other processes since the last sync.
+        Our own changes are told apart by counting our own bumps,
+        since each bump adds exactly one to the counter.
+        The nodes changed by others are loaded anew,
+        or the whole network if what changed is not known.
+        '''
+        lexicon, network = Generation.get(self.session)
+        self.lexicon.sync(lexicon)
+        if network != self.generation + self.bumps:
+            changed = Generation.changes(self.session, 'network',
+                                         self.generation, network)
+            if changed is None or not self._update_nodes(changed):
+                self.root = self._load_nodes()
+                self.memories = {}
+            else:
+                self._sync_memories()
+            self.programs, self.rule_programs = {}, {}
+        else:
+            self._sync_memories()
+        self.generation = network
+        self.bumps = 0
+        self.present.sync()
+        self.past.sync()
+
+    def mark_stale(self):
+        '''
+        Make the next sync drop all caches,
+        e.g. after a rollback undoes changes already cached.
+        '''
+        self.lexicon.mark_stale()
+        self.generation = -1
+        self.bumps = 0
+        self._changed_nodes = set()
+        self.memories = {}
+        self.activations.clear()
+        self.present.sync()
+        self.past.sync()
+
+    def _bump(self):
+        '''
+        Bump the counter of the network,
+        recording the nodes changed since the last bump.
+        '''
+        Generation.bump(self.session, 'network', self._changed_nodes)
+        self._changed_nodes = set()
+        self.bumps += 1
+        self.programs, self.rule_programs = {}, {}
+
+    def _bump_matches(self, pnid):
+        '''
+        Bump the counter of the matches of the PremNode with id pnid,
+        once per transaction,
+        and along with it that of its memory, if loaded.
+        '''
+        if self._matches_txn is not self.session.transaction:
+            self._matches_bumped, self._matches_txn = set(), self.session.transaction
+        if pnid in self._matches_bumped:
+            return
+        table = PremNode.__table__
+        q = table.update().where(table.c.id==pnid)
+        self.session.execute(q.values(generation=table.c.generation + 1))
+        self._matches_bumped.add(pnid)
+        memory = self.memories.get(pnid)
+        if memory is not None:
+            memory.generation += 1
+
+    def _sync_memories(self):
+        '''
+        Drop the memories of the PremNodes
+        whose matches have been changed by other processes,
+        checking the counters of all of them with a query per chunk.
+        '''
+        table = PremNode.__table__
+        pnids = list(self.memories)
+        current = {}
+        for start in range(0, len(pnids), 500):
+            q = sql.select([table.c.id, table.c.generation])
+            q = q.where(table.c.id.in_(pnids[start:start + 500]))
+            current.update(tuple(row) for row in self.session.execute(q))
+        for pnid in pnids:
+            if current.get(pnid) != self.memories[pnid].generation:
+                del self.memories[pnid]
 
     @classmethod
     def initialize(self, session):
@@ -59,6 +167,33 @@ class Network(object):
             session.add(root)
             Lexicon.initialize(session)
 
+    @classmethod
+    def upgrade(cls, session, config):
+        '''
+        Fill in what a knowledge base made by an older version lacks,
+        once the tables and columns have been added to the db:
+        the taxonomy (see Lexicon.upgrade), the paths, keys and stats
+        of the facts (see FactSet.upgrade), the counters of the premnodes,
+        and the premnodes and values of the pairs of their matches,
+        that used to be in a tpairs and a ppairs tables.
+        '''
+        Lexicon.upgrade(session)
+        session.flush()
+        lexicon = Lexicon(session, config)
+        FactSet('present', lexicon, config, unique=True).upgrade()
+        FactSet('past', lexicon, config).upgrade()
+        pnodes = PremNode.__table__
+        session.execute(pnodes.update().where(pnodes.c.generation==None).values(generation=0))
+        pairs, pmatchs = MPair.__table__, PMatch.__table__
+        prem_id = sql.select([pmatchs.c.prem_id]).where(pmatchs.c.id==pairs.c.parent_id)
+        session.execute(pairs.update().where(pairs.c.prem_id==None).values(prem_id=prem_id.as_scalar()))
+        dialect = session.get_bind().dialect
+        for name, col in (('tpairs', 'term_id'), ('ppairs', 'pred_id')):
+            if dialect.has_table(session.connection(), name):
+                old = sql.table(name, sql.column('mid'), sql.column(col))
+                value = sql.select([old.c[col]]).where(old.c.mid==pairs.c.id).as_scalar()
+                session.execute(pairs.update().where(pairs.c[col]==None).values({col: value}))
+
     def passtime(self):
         past = eval(self.now, {}, {})
         now = 0
@@ -75,9 +210,9 @@ class Network(object):
                 new_pred = f.pred.copy()
             except Exception as e:
                 logger.error('Exception passing {!r}: {!r}'.format(f.pred, e))
-                self.session.delete(f)
+                self.delete_fact(f)
             else:
-                self.session.delete(f)
+                self.delete_fact(f)
                 new_pred.add_object('at_', self.lexicon.now_term)
                 self.past.add_fact(new_pred)
                 self.session.flush()
@@ -126,48 +261,317 @@ class Network(object):
         mapper = Node.__mapper__
         return mapper.base_mapper.polymorphic_map[ntype].class_
 
+    def _load_nodes(self):
+        '''
+        Load the primary network into memory,
+        and return the AlphaNode that mirrors the RootNode.
+        The words in the nodes, and their bases,
+        are loaded with a query per chunk of nodes.
+        '''
+        self.nodes = {}
+        terminals = dict(self.session.query(PremNode.parent_id, PremNode.id))
+        nodes = self.session.query(with_polymorphic(Node, '*')).populate_existing().all()
+        value_ids = {getattr(node, 'term_id', None) or getattr(node, 'verb_id', None)
+                     for node in nodes} - {None}
+        values, bases = {}, {term_id: [] for term_id in value_ids}
+        value_ids = list(value_ids)
+        tb = term_to_base.c
+        for start in range(0, len(value_ids), 500):
+            chunk = value_ids[start:start + 500]
+            values.update((t.id, t) for t in self.session.query(Term).filter(Term.id.in_(chunk)))
+            q = self.session.query(tb.term_id, tb.base_id).filter(tb.term_id.in_(chunk))
+            for term_id, base_id in q.order_by(tb.term_id, tb.base_id):
+                bases[term_id].append(base_id)
+        root = None
+        for node in nodes:
+            value_id = getattr(node, 'term_id', None) or getattr(node, 'verb_id', None)
+            alpha = AlphaNode(node, self.lexicon, terminals.get(node.id),
+                              base_ids=bases.get(value_id))
+            self.nodes[alpha.id] = alpha
+            if isinstance(node, RootNode):
+                root = alpha
+        for alpha in self.nodes.values():
+            if alpha.parent_id is not None:
+                self.nodes[alpha.parent_id].add_child(alpha)
+        return root
+
+    def _update_nodes(self, node_ids):
+        '''
+        Bring up to date the in-memory mirrors of the nodes with node_ids,
+        that someone else has added, removed,
+        or given children or premises.
+        Return False if the network has to be loaded anew instead.
+        '''
+        node_ids = list(node_ids)
+        nodes, terminals = [], {}
+        for start in range(0, len(node_ids), 500):
+            chunk = node_ids[start:start + 500]
+            q = self.session.query(with_polymorphic(Node, '*')).populate_existing()
+            nodes.extend(q.filter(Node.id.in_(chunk)))
+            q = self.session.query(PremNode.parent_id, PremNode.id)
+            terminals.update(q.filter(PremNode.parent_id.in_(chunk)))
+        found = set()
+        for node in sorted(nodes, key=lambda n: n.id):  # parents first
+            found.add(node.id)
+            alpha = self.nodes.get(node.id)
+            if alpha is None:
+                parent = self.nodes.get(node.parent_id)
+                if parent is None:
+                    return False
+                alpha = AlphaNode(node, self.lexicon)
+                self.nodes[alpha.id] = alpha
+                parent.add_child(alpha)
+            alpha.child_path = node.child_path
+            alpha.terminal_id = terminals.get(node.id)
+        for node_id in set(node_ids) - found:
+            alpha = self.nodes.get(node_id)
+            if alpha is not None:
+                self._forget_node(alpha)
+        return True
+
+    def remove_node(self, alpha):
+        '''
+        Remove a node, with all its descendants,
+        both from the db and from the in-memory network.
+        '''
+        node = self.session.query(Node).get(alpha.id)
+        self.session.delete(node)
+        self._changed_nodes.add(alpha.id)
+        self._bump()
+        self._forget_node(alpha)
+
+    def _forget_node(self, alpha):
+        '''
+        Remove a node, with all its descendants,
+        from the in-memory network.
+        '''
+        alpha.parent.remove_child(alpha)
+        pending = [alpha]
+        while pending:
+            alpha = pending.pop()
+            del self.nodes[alpha.id]
+            self.memories.pop(alpha.terminal_id, None)
+            pending.extend(alpha.children)
+
     def add_fact(self, pred):
+        return self.add_facts([pred])[0]
+
+    def add_facts(self, preds):
+        '''
+        Add a batch of facts to the present factset.
+        The facts that finish previous facts (exclusive and finish facts)
+        are added one at a time, in their order in the batch,
+        and the runs of facts between them as sub-batches.
+        Return the facts (new or already present) in the order of preds.
+        '''
+        numbers = {}
+        for pred in preds:
+            self._share_numbers(pred, numbers)
+        facts, batch = [], []
+        for pred in preds:
+            if isa(pred, self.lexicon.exclusive_endure) or isa(pred, self.lexicon.finish):
+                facts.extend(self._add_batch(batch))
+                batch = []
+                self.finish_previous(pred)
+                facts.extend(self._add_batch([pred]))
+            else:
+                batch.append(pred)
+        facts.extend(self._add_batch(batch))
+        return facts
+
+    def _add_batch(self, preds):
+        '''
+        Add a batch of facts that do not finish previous facts.
+        The duplicates in the batch are looked for with a single query,
+        the new facts are inserted together,
+        and their matches are pushed through the network level by level,
+        before processing the resulting activations.
+        '''
+        if not preds:
+            return []
         factset = self.present
-        if isa(pred, self.lexicon.exclusive_endure):
-            old_pred = Predicate(pred.true, pred.term_type)
-            old_pred.add_object('subj', pred.get_object('subj'))
-            for label in pred.objects:
-                if label.startswith('u-'):
-                    old_pred.add_object(label, pred.get_object(label))
-            self.finish(old_pred)
-        elif isa(pred, self.lexicon.finish):
-            tofinish = pred.get_object('what')
-            self.finish(tofinish)
         #neg = pred.copy()
         #neg.true = not neg.true
         #contradiction = factset.query(neg)
         #if contradiction:
         #    raise exceptions.Contradiction('we already have ' + str(neg))
 
-        facts = factset.query_facts(pred, {})
-        if facts.count() == 0:
+        found = factset.find_facts(preds)
+        facts = [None] * len(preds)
+        new = {}
+        for n, pred in enumerate(preds):
+            if n in found:
+                facts[n] = found[n]
+            else:
+                new.setdefault(str(pred), []).append(n)
+        if not new:
+            return facts
+        topreds = [preds[ns[0]] for ns in new.values()]
+        for pred in topreds:
             if isa(pred, self.lexicon.endure):
                 pred.add_object('since_', self.lexicon.now_term)
-            fact = factset.add_fact(pred)
+        newfacts = factset.add_facts(topreds)
+        for ns, fact in zip(new.values(), newfacts):
+            for n in ns:
+                facts[n] = fact
+        for pred in topreds:
             if isa(pred, self.lexicon.happen):
                 if self.pipe is not None:
                     self.pipe.send_bytes(str(pred).encode('utf8'))
-            if self.root.child_path:
-                m = Match(pred)
-                m.paths = self.get_paths(pred)
+        if self.root.child_path:
+            matches = []
+            for fact in newfacts:
+                m = Match(fact.pred)
+                m.paths = self.get_paths(fact.pred)
                 m.fact = fact
-                Node.dispatch(self.root, m, self)
-            n = 0
-            while self.activations:
-                n += 1
-                cmc = int(self.config['commit_many_consecuences'])
-                if cmc and n % cmc == 0:
-                    self.session.commit()
-                match = self.activations.pop(0)
-                Node.dispatch(self.root, match, self)
-            return fact
+                matches.append(m)
+            self.propagate(matches)
+        n = 0
+        while self.activations:
+            n += 1
+            cmc = int(self.config['commit_many_consecuences'])
+            if cmc and n % cmc == 0:
+                self.session.commit()
+            match = self.activations.pop()
+            Node.dispatch(self.root, match, self)
+        if n:
+            logger.debug('agenda: {} activations, high water {}'.format(
+                n, self.activations.high_water))
+        return facts
+
+    def propagate(self, matches):
+        '''
+        Push a batch of matches through the primary network,
+        breadth first, one level of nodes at a time.
+        '''
+        level = [(self.root, m) for m in matches]
+        while level:
+            next_level = []
+            for parent, match in level:
+                next_level.extend(Node.get_matches(parent, match, self))
+                if parent.terminal_id:
+                    self.get_premnode(parent.terminal_id).dispatch(match, self)
+            level = next_level
+
+    def get_premnode(self, pnid):
+        return self.session.query(PremNode).get(pnid)
+
+    def get_programs(self, pnid):
+        '''
+        Get the RulePrograms for the premises in the PremNode with id pnid,
+        as (program, order of the premise in the rule) tuples.
+        The programs are built the first time and kept
+        until the rules in the network change.
+        '''
+        try:
+            return self.programs[pnid]
+        except KeyError:
+            pass
+        programs = []
+        prems = self.session.query(Premise).filter(Premise.prem_id==pnid)
+        for prem in prems.order_by(Premise.id):
+            program = self.rule_programs.get(prem.rule_id)
+            if program is None:
+                program = RuleProgram(prem.rule, self)
+                self.rule_programs[prem.rule_id] = program
+            programs.append((program, prem.order))
+        self.programs[pnid] = programs
+        return programs
+
+    def get_memory(self, pnid):
+        '''
+        Get the memory for the matches of the PremNode with id pnid:
+        a BetaMemory, loaded from the db the first time,
+        or, if premise_memory is off in the config,
+        a DBMemory that looks them up in the db each time.
+        '''
+        try:
+            return self.memories[pnid]
+        except KeyError:
+            pass
+        if not int(self.config.get('premise_memory', 1)):
+            return DBMemory(pnid, self)
+        table = PremNode.__table__
+        q = sql.select([table.c.generation]).where(table.c.id==pnid)
+        memory = BetaMemory(self.session.execute(q).scalar())
+        pmatches = self.session.query(PMatch).filter(PMatch.prem_id==pnid)
+        bindings = self.load_bindings(pnid)
+        for pmatch in pmatches.order_by(PMatch.id):
+            memory.add(pmatch, bindings.get(pmatch.id, {}))
+        self.memories[pnid] = memory
+        return memory
+
+    def load_bindings(self, pnid, pmids=None):
+        '''
+        Load the values of the variables in the matches
+        of the PremNode with id pnid,
+        or in those with ids in pmids if given.
+        Return a dict of match ids to dicts of variable numbers to values.
+        '''
+        pairs = MPair.__table__
+        q = self.session.query(pairs.c.parent_id, pairs.c.var,
+                               pairs.c.term_id, pairs.c.pred_id)
+        q = q.filter(pairs.c.prem_id==pnid)
+        if pmids is None:
+            rows = q.all()
         else:
-            return facts.first()
+            rows = []
+            for start in range(0, len(pmids), 500):
+                rows.extend(q.filter(pairs.c.parent_id.in_(pmids[start:start + 500])))
+        vals = {}
+        for cls, n in ((Term, 2), (Predicate, 3)):
+            ids = list({row[n] for row in rows if row[n] is not None})
+            for start in range(0, len(ids), 500):
+                objs = self.session.query(cls).filter(cls.id.in_(ids[start:start + 500]))
+                vals.update(((cls, o.id), o) for o in objs)
+        bindings = {}
+        for pmid, var, term_id, pred_id in rows:
+            if term_id is not None:
+                val = vals[(Term, term_id)]
+            else:
+                val = vals[(Predicate, pred_id)]
+            bindings.setdefault(pmid, {})[var] = val
+        return bindings
+
+    def remember(self, pnode, pmatch, pairs):
+        '''
+        Add a new match, with its pairs of variable numbers and values,
+        to the BetaMemory of pnode, if loaded.
+        The match itself is written to the db by the caller.
+        '''
+        memory = self.memories.get(pnode.id)
+        if memory is not None:
+            memory.add(pmatch, pairs)
+        self._bump_matches(pnode.id)
+
+    def _share_numbers(self, pred, numbers):
+        '''
+        Make the predicates in a batch share the new number terms
+        (not yet in the db) that they mention,
+        kept by name in numbers,
+        so that each is inserted only once.
+        '''
+        for o in pred.objects.values():
+            if isinstance(o.value, Predicate):
+                self._share_numbers(o.value, numbers)
+            elif o.value.id is None and o.value.number:
+                o.value = numbers.setdefault(o.value.name, o.value)
+
+    def finish_previous(self, pred):
+        '''
+        Finish the facts that are superseded by pred,
+        if it is exclusive or a finish fact.
+        '''
+        if isa(pred, self.lexicon.exclusive_endure):
+            old_pred = Predicate(pred.true, pred.term_type)
+            old_pred.add_object('subj', pred.get_object('subj'))
+            for label in pred.objects:
+                if label.startswith('u-'):
+                    old_pred.add_object(label, pred.get_object(label))
+            self.finish(old_pred)
+        elif isa(pred, self.lexicon.finish):
+            tofinish = pred.get_object('what')
+            self.finish(tofinish)
 
     def finish(self, predicate):
         fs = self.present.query_facts(predicate, {})
@@ -175,13 +579,28 @@ class Network(object):
             if isa(f.pred, self.lexicon.endure):
                 logger.info('Finish: ' + str(f.pred))
                 new_pred = f.pred.copy()
-                self.session.delete(f)
+                self.delete_fact(f)
                 new_pred.add_object('at_', self.lexicon.now_term)
                 self.past.add_fact(new_pred)
                 self.session.flush()
 
     def del_fact(self, pred):
         fact = self.present.query_facts(pred, {}).one()
+        self.delete_fact(fact)
+
+    def delete_fact(self, fact):
+        '''
+        Delete a fact from the db,
+        and its matches from the beta memories.
+        The matches are reloaded, since other processes may have added some
+        since the fact was loaded.
+        '''
+        self.session.expire(fact, ['matches'])
+        for pmatch in fact.matches:
+            memory = self.memories.get(pmatch.prem_id)
+            if memory is not None:
+                memory.remove(pmatch)
+            self._bump_matches(pmatch.prem_id)
         self.session.delete(fact)
 
     def add_rule(self, prems, conds, condcode, cons):
@@ -192,11 +611,14 @@ class Network(object):
             old_node = self.root
             for path in paths:
                 old_node = self.get_or_create_node(old_node, pred, path, vars, rule)
-            if old_node.terminal:
-                pnode = old_node.terminal
+            if old_node.terminal_id:
+                pnode = self.get_premnode(old_node.terminal_id)
             else:
-                pnode = PremNode(old_node)
-                old_node.terminal = pnode
+                pnode = PremNode(self.session.query(Node).get(old_node.id))
+                self.session.add(pnode)
+                self.session.flush()
+                old_node.terminal_id = pnode.id
+                self._changed_nodes.add(old_node.id)
             premise = Premise(pnode, n, pred)
             rule.prems.append(premise)
             for n, varname in vars.values():
@@ -208,6 +630,8 @@ class Network(object):
                 rule.consecuences.append(con)
             else:
                 rule.vconsecuences.append(con)
+        self.session.flush()
+        program = RuleProgram(rule, self)
         for prem in rule.prems:
             matches = self.present.query(prem.pred)
             for match in matches:
@@ -215,31 +639,253 @@ class Network(object):
                     prem.node.matches.filter(PMatch.fact==match.fact).one()
                 except NoResultFound:
                     m = PMatch(prem.node, match.fact)
+                    pairs = {}
                     for var, val in match.items():
-                        numvar = prem.name_to_num(var)
-                        m.pairs.append(MPair.make_pair(numvar, val))
-                prem.dispatch(match, self)
+                        numvar = program.name_to_num(prem.order, var)
+                        m.pairs.append(MPair.make_pair(prem.node, numvar, val))
+                        pairs[numvar] = val
+                    self.remember(prem.node, m, pairs)
+                program.activate(prem.order, match, self)
+        self._bump()
         return rule
 
 
+    def get_factset(self, pred):
+        if set(pred.objects).intersection({'at_', 'till_'}):
+            return self.past
+        return self.present
+
     def query(self, *q):
-        submatches = []
+        if not q:
+            return []
+        if len(q) > 1:
+            return list(self.iquery(*q))
+        return self._merge([self.get_factset(q[0]).query(q[0])])
+
+    def ask(self, *q):
+        '''
+        Answer a question without variables,
+        asking for each of its facts in turn,
+        and stopping at the first that is not in the db.
+        '''
+        return all(self.get_factset(pred).exists(pred) for pred in q)
+
+    def iquery(self, *q, limit=None, offset=None, order=None):
+        '''
+        Like query, but as a generator.
+        The question is answered by a single query,
+        with its facts joined in the db on their shared variables,
+        that only gives distinct matches, so nothing is kept here.
+        limit and offset page through the matches in the db;
+        order is the name of a number variable to sort them by,
+        prefixed with a minus for descending order.
+        '''
+        return self._iquery_joined(q, limit=limit, offset=offset, order=order)
+
+    def count(self, *q):
+        '''
+        Count the matches for a question in the db, without loading them.
+        A question without variables counts 1 if it is true.
+        '''
+        qfacts, subqs, vars = self._join_facts(q)
+        if not vars:
+            return int(self.ask(*q))
+        rows = qfacts.with_entities(*self._select_vars(subqs, vars)[0]).distinct()
+        return self.session.query(func.count()).select_from(rows.subquery()).scalar()
+
+    def _join_facts(self, q, plan=None):
+        '''
+        Build a single query for all the facts in a question.
+        The query for each fact, as built by its factset,
+        is a common table expression that gives the id of the fact
+        and the values of its variables, and these are joined
+        on the variables they share.
+        On postgresql they are materialized, so that each is run once
+        and its poor row estimate does not lead the planner to run it
+        again for each row of the others
+        (before postgresql 12 they always were, and cannot be asked to).
+        If plan is a list, the plan for each fact is appended to it
+        as a (pred, factset, [(path, value, estimate), ...]) tuple.
+        Return the query, the subqueries, and a dict of variable names
+        to (index of the first fact with it, path).
+        '''
+        built, seen = [], {}
         for pred in q:
-            factset = self.present
-            if set(pred.objects).intersection({'at_', 'till_'}):
-                factset = self.past
-            smatches = factset.query(pred)
-            submatches.append(smatches)
+            factset = self.get_factset(pred)
+            pplan = None
+            if plan is not None:
+                pplan = []
+                plan.append((pred, factset, pplan))
+            taken_vars = {}
+            sq = factset.query_facts(pred, taken_vars, plan=pplan)
+            built.append((factset, sq, taken_vars))
+            for name in taken_vars:
+                seen[name] = seen.get(name, 0) + 1
+        subqs, vars = [], {}
+        qfacts = None
+        for n, (factset, sq, taken_vars) in enumerate(built):
+            cols = [Fact.id.label('fact_id')]
+            for name, (path, alias) in taken_vars.items():
+                cls = factset._get_nclass(path)
+                if seen[name] > 1 and is_pred_var(name, cls):
+                    sq, col = self._nested_pred(sq, path)
+                else:
+                    col = alias.c[cls.value_column]
+                cols.append(col.label(name))
+            sq = sq.with_entities(*cols).cte('fact_%d' % n)
+            if self.materialize:
+                sq = sq.prefix_with('MATERIALIZED', dialect='postgresql')
+            conds = []
+            for name, (path, alias) in taken_vars.items():
+                if name in vars:
+                    conds.append(sq.c[name] == subqs[vars[name][0]].c[name])
+                else:
+                    vars[name] = (n, path)
+            if qfacts is None:
+                qfacts = self.session.query(sq.c.fact_id).select_from(sq)
+            else:
+                qfacts = qfacts.join(sq, and_(*conds) if conds else true())
+            subqs.append(sq)
+        return qfacts, subqs, vars
+
+    def _nested_pred(self, qfacts, path):
+        '''
+        Join to the query for some facts the objects
+        down path to a predicate nested in them,
+        and return the query and the column with the id of the predicate,
+        that variables for whole predicates are joined on,
+        since the segments only have its verb.
+        '''
+        col = Fact.pred_id
+        for label in path[:-1]:
+            alias = Object.__table__.alias()
+            qfacts = qfacts.join(alias, and_(alias.c.parent_id==col, alias.c.label==label))
+            col = alias.c.pred_id
+        return qfacts, col
+
+    def _select_vars(self, subqs, vars):
+        '''
+        Get the columns to select for the variables in a joined question,
+        and a dict of variable names to (kind, index of the column, path, class),
+        kind being 'pred' for variables for whole predicates,
+        that take the id of their fact, 'num' for numbers, and 'term'.
+        '''
+        cols, getters = [], {}
+        for name, (n, path) in vars.items():
+            cls = self.present._get_nclass(path)
+            if is_pred_var(name, cls):
+                kind, col = 'pred', subqs[n].c.fact_id
+            else:
+                kind = 'num' if cls is NumberSegment else 'term'
+                col = subqs[n].c[name]
+            getters[name] = (kind, len(cols), path, cls)
+            cols.append(col)
+        return cols, getters
+
+    def _iquery_joined(self, q, chunk=1000, limit=None, offset=None, order=None):
+        '''
+        Get the matches for a question,
+        selecting just the distinct values of the variables;
+        only facts with variables for whole predicates are loaded.
+        The words and facts for the values are loaded a chunk at a time,
+        and only kept for that chunk.
+        When paging, the rows are sorted by order (if given)
+        and then by all the values, so that pages are stable.
+        '''
+        qfacts, subqs, vars = self._join_facts(q)
+        if not vars:
+            if not offset and limit != 0 and self.ask(*q):
+                yield Match(None)
+            return
+        cols, getters = self._select_vars(subqs, vars)
+        rows = qfacts.with_entities(*cols).distinct()
+        if order is not None:
+            name = order.lstrip('-')
+            if name not in getters or getters[name][0] != 'num':
+                raise exceptions.TermsSyntaxError(
+                    'Can only order by a number variable, not ' + name)
+            col = cols[getters[name][1]]
+            rows = rows.order_by(col.desc() if order.startswith('-') else col)
+        if (limit, offset) != (None, None):
+            rows = rows.order_by(*cols).limit(limit).offset(offset)
+        rows = iter(rows.yield_per(chunk))
+        while True:
+            batch = list(itertools.islice(rows, chunk))
+            if not batch:
+                return
+            terms, facts = {}, {}
+            for kind, cls, loaded in (('term', Term, terms), ('pred', Fact, facts)):
+                ids = {row[i] for k, i, _, _ in getters.values() if k == kind
+                       for row in batch} - set(loaded)
+                ids = list(ids)
+                for start in range(0, len(ids), 500):
+                    objs = self.session.query(cls).filter(cls.id.in_(ids[start:start + 500]))
+                    loaded.update((o.id, o) for o in objs)
+            for row in batch:
+                match = Match(None)
+                for name, (kind, i, path, cls) in getters.items():
+                    if kind == 'term':
+                        match[name] = terms[row[i]]
+                    elif kind == 'num':
+                        match[name] = self.lexicon.make_term(str(row[i]), self.lexicon.number)
+                    else:
+                        match[name] = cls.resolve(facts[row[i]].pred, path, self.present, preds=True)
+                yield match
+
+    def _merge(self, submatches):
         matches = merge_submatches(submatches)
+        seen = set()
         unique = []
         for m in matches:
-            for m2 in unique:
-                if m2 == m:
-                    break
-            else:
+            key = binding_key(m)
+            if key not in seen:
+                seen.add(key)
                 unique.append(m)
         return unique
 
+    def prepare(self, q, params):
+        '''
+        Build the statements for a question,
+        with bind parameters for the variables in params,
+        that must be objects (words or numbers) in the question.
+        Return a list of (factset, pred, statement, taken vars) tuples,
+        to be run with execute.
+        '''
+        prepared = []
+        used = set()
+        for pred in q:
+            factset = self.get_factset(pred)
+            stmt, taken_vars, pused = factset.prepare(pred, params)
+            prepared.append((factset, pred, stmt, taken_vars))
+            used |= pused
+        unused = set(params) - used
+        if unused:
+            raise exceptions.TermsSyntaxError('Parameters must be variable '
+                    'objects in the question: ' + ', '.join(sorted(unused)))
+        return prepared
+
+    def execute(self, prepared, values):
+        '''
+        Answer a question built by prepare,
+        with values (a dict of param names to word ids or numbers).
+        '''
+        submatches = []
+        for factset, pred, stmt, taken_vars in prepared:
+            smatches = factset.execute(pred, stmt, taken_vars, values)
+            submatches.append(smatches)
+        return self._merge(submatches)
+
+    def explain(self, *q):
+        if len(q) == 1:
+            return '\n'.join(self.get_factset(q[0]).explain(q[0]))
+        plan = []
+        qfacts = self._join_facts(q, plan=plan)[0]
+        lines = []
+        for pred, factset, pplan in plan:
+            lines.extend(factset.explain_plan(pred, pplan))
+        lines.extend(explain_query(self.session, qfacts))
+        return '\n'.join(lines)
+
     def get_or_create_node(self, parent, term, path, vars, rule):
         ntype_name = path[-1]
         cls = self._get_nclass(ntype_name)
@@ -265,20 +911,26 @@ class Network(object):
                 vars[rname] = (rnum, Varname(redundant_var, rule))
             else:
                 rnum = vars[rname][0]
-        try:
-            nodes = self.session.query(cls).filter(cls.parent_id==parent.id, cls.var==pnum)
-            if redundant_var:
-                nodes = nodes.filter(cls.redundant_var==rnum)
-            node = nodes.filter(cls.value==value).one()
-        except NoResultFound:
+        if getattr(value, 'id', False) is None:
+            self.session.add(value)
+            self.session.flush()
+        node = parent.get_child(value, pnum, rnum if redundant_var else None)
+        if node is None:
             #  build the node and append it
-            node = cls(value)
-            node.var = pnum
+            onode = cls(value)
+            onode.var = pnum
             if redundant_var:
-                node.redundant_var = rnum
-            parent.children.append(node)
+                onode.redundant_var = rnum
+            oparent = self.session.query(Node).get(parent.id)
+            oparent.children.append(onode)
             if not parent.child_path:
+                oparent.child_path = path
                 parent.child_path = path
+            self.session.flush()
+            node = AlphaNode(onode, self.lexicon)
+            self.nodes[node.id] = node
+            parent.add_child(node)
+            self._changed_nodes.update((node.id, parent.id))
         return node
 
 
@@ -335,6 +987,18 @@ class Node(Base):
 
     @classmethod
     def dispatch(cls, parent, match, network):
+        for child, new_match in cls.get_matches(parent, match, network):
+            cls.dispatch(child, new_match, network)
+        if parent.terminal_id:
+            network.get_premnode(parent.terminal_id).dispatch(match, network)
+
+    @classmethod
+    def get_matches(cls, parent, match, network):
+        '''
+        Get the children of parent (an AlphaNode) that match,
+        each with the match extended with the variables it binds.
+        '''
+        matches = []
         if parent.child_path:
             path = parent.child_path
             ntype_name = path[-1]
@@ -349,7 +1013,7 @@ class Node(Base):
                     new_match = match.copy()
                     if child.var:
                         val = None
-                        if chcls is VerbNode and isa(child.value, network.lexicon.exist):
+                        if chcls is VerbNode and child.value_exist:
                             val = TermNode.resolve(match.pred, path)
                         else:
                             val = value
@@ -358,11 +1022,10 @@ class Node(Base):
                         new_match[child.var] = val
                     if chcls is VerbNode and child.redundant_var:
                         new_match[child.redundant_var] = TermNode.resolve(match.pred, path)
-                    chcls.dispatch(child, new_match, network)
+                    matches.append((child, new_match))
         else:
             logger.debug('parent {!r} has no child path'.format(parent))
-        if parent.terminal:
-            parent.terminal.dispatch(match, network)
+        return matches
 
     @classmethod
     def get_children(cls, parent, value, factset):
@@ -415,7 +1078,7 @@ class NegNode(Node):
 
     @classmethod
     def get_children(cls, parent, value, network):
-        return [network.session.query(cls).filter(cls.parent_id==parent.id, (cls.value==value) | (cls.value==None))]
+        return parent.get_children_by_value(value),
 
 
 class TermNode(Node):
@@ -450,21 +1113,12 @@ class TermNode(Node):
     def get_children(cls, parent, value, network):
         if isa(value, network.lexicon.exist):
             types = (value.term_type.term_type,) + get_bases(value.term_type.term_type)
-            type_ids = [t.id for t in types]
-            return network.session.query(cls).filter(cls.parent_id==parent.id, Node.var>0).join(Term, cls.term_id==Term.id).filter(Term.type_id.in_(type_ids)),
-        children = network.session.query(cls).filter(cls.parent_id==parent.id, (cls.value==value) | (cls.value==None))
+            return [ch for ch in parent.get_children_by_types(types) if ch.var > 0],
+        children = parent.get_children_by_value(value)
         vchildren = ()
         if value is not None:
             types = (value.term_type,) + get_bases(value.term_type)
-            type_ids = [t.id for t in types]
-            if type_ids:
-                vchildren = network.session.query(cls).filter(cls.parent_id==parent.id).join(Term, cls.term_id==Term.id).filter(Term.var==True).filter(Term.type_id.in_(type_ids))
-#         if not isa(value, network.lexicon.thing) and not isa(value, network.lexicon.number):
-#             bases = (value,) + get_bases(value)
-#             tbases = aliased(Term)
-#             base_ids = (b.id for b in bases)
-#             if base_ids and vchildren:
-#                 vchildren = vchildren.join(term_to_base, Term.id==term_to_base.c.term_id).join(tbases, term_to_base.c.base_id==tbases.id).filter(tbases.id.in_(base_ids))  # XXX can get duplicates
+            vchildren = [ch for ch in parent.get_children_by_types(types) if ch.value_var]
         return children, vchildren
 
 
@@ -494,20 +1148,198 @@ class VerbNode(Node):
 
     @classmethod
     def get_children(cls, parent, value, network):
-        children = network.session.query(cls).filter(cls.parent_id==parent.id, (cls.value==value) | (cls.value==None))
+        children = parent.get_children_by_value(value)
         pchildren, vchildren = [], []
         if value is not None:
             types = (value,) + get_bases(value)
-            type_ids = [t.id for t in types]
-            chvars = network.session.query(cls).filter(cls.parent_id==parent.id, Node.var>0)
             # VerbNodes var>0 whose verb_id points to a verb of type the one in value or one of its bases
-            pchildren = chvars.join(Term, cls.verb_id==Term.id).filter(Term.type_id.in_(type_ids))
-            tbases = aliased(Term)
+            pchildren = [ch for ch in parent.get_children_by_types(types) if ch.var > 0]
             # VerbNodes var>0 whose verb_id points to a subverb of the one in value or one of its bases
-            vchildren = chvars.join(Term, cls.verb_id==Term.id).join(term_to_base, Term.id==term_to_base.c.term_id).join(tbases, term_to_base.c.base_id==tbases.id).filter(tbases.id.in_(type_ids))
+            vchildren = [ch for ch in parent.get_children_by_bases(types) if ch.var > 0]
         return children, pchildren, vchildren
 
 
+class AlphaNode(object):
+    '''
+    In-memory mirror of a Node in the primary network.
+    Children are hashed by the id of their value,
+    and variable children are also bucketed by the ids
+    of the type and of the bases of their value,
+    so that dispatching a match does not need the db.
+    '''
+
+    def __init__(self, node, lexicon, terminal_id=None, base_ids=None):
+        self.id = node.id
+        self.ntype = node.ntype
+        self.parent_id = node.parent_id
+        self.parent = None
+        self.child_path = node.child_path
+        self.var = node.var or 0
+        self.redundant_var = node.redundant_var or 0
+        self.terminal_id = terminal_id
+        value = getattr(node, 'value', None)
+        self.value_key = self._get_key(value)
+        self.value_var = bool(getattr(value, 'var', False))
+        self.value_exist = isa(value, lexicon.exist)
+        self.type_id = getattr(value, 'type_id', None)
+        if base_ids is None:
+            base_ids = [b.id for b in getattr(value, 'bases', ())]
+        self.base_ids = base_ids
+        self.children = []
+        self.by_value = {}
+        self.by_type = {}
+        self.by_base = {}
+
+    def __str__(self):
+        return '<AlphaNode {}: {!r}>'.format(self.ntype, self.value_key)
+
+    @staticmethod
+    def _get_key(value):
+        if isinstance(value, (Term, Predicate)):
+            return ('id', value.id)
+        return value
+
+    def add_child(self, child):
+        child.parent = self
+        self.children.append(child)
+        self.by_value.setdefault(child.value_key, []).append(child)
+        if child.var > 0 or child.value_var:
+            self.by_type.setdefault(child.type_id, []).append(child)
+            for base_id in child.base_ids:
+                self.by_base.setdefault(base_id, []).append(child)
+
+    def remove_child(self, child):
+        self.children.remove(child)
+        self.by_value[child.value_key].remove(child)
+        if child.var > 0 or child.value_var:
+            self.by_type[child.type_id].remove(child)
+            for base_id in child.base_ids:
+                self.by_base[base_id].remove(child)
+        child.parent = None
+
+    def get_child(self, value, var, redundant_var=None):
+        for child in self.by_value.get(self._get_key(value), ()):
+            if child.var != var:
+                continue
+            if redundant_var is not None and child.redundant_var != redundant_var:
+                continue
+            return child
+
+    def get_children_by_value(self, value):
+        children = self.by_value.get(None, [])
+        if value is not None:
+            children = self.by_value.get(self._get_key(value), []) + children
+        return children
+
+    def get_children_by_types(self, types):
+        children = []
+        for t in types:
+            children.extend(self.by_type.get(t.id, ()))
+        return children
+
+    def get_children_by_bases(self, bases):
+        children = []
+        for b in bases:
+            for child in self.by_base.get(b.id, ()):
+                if child not in children:
+                    children.append(child)
+        return children
+
+
+class BetaMemory(object):
+    '''
+    The matches of a PremNode, kept in memory,
+    each as a dict of variable numbers to values,
+    and indexed by the number of each variable and the id of its value.
+    The network loads it from the db on first use,
+    and writes through to it the matches it adds or deletes.
+    generation is the counter of the matches of the PremNode
+    that the memory is up to date with.
+    '''
+
+    def __init__(self, generation=0):
+        self.generation = generation
+        self.matches = {}
+        self.index = {}
+
+    @staticmethod
+    def _key(pair):
+        var, val = pair
+        return (var, isinstance(val, Predicate), val.id)
+
+    def __len__(self):
+        return len(self.matches)
+
+    def add(self, pmatch, pairs):
+        self.matches[pmatch] = pairs
+        for pair in pairs.items():
+            self.index.setdefault(self._key(pair), {})[pmatch] = None
+
+    def remove(self, pmatch):
+        pairs = self.matches.pop(pmatch, None)
+        if pairs is None:
+            return
+        for pair in pairs.items():
+            key = self._key(pair)
+            pmatches = self.index[key]
+            del pmatches[pmatch]
+            if not pmatches:
+                del self.index[key]
+
+    def lookup(self, pvar_map):
+        '''
+        Get the pairs of the matches that have all the
+        (number, value) pairs in pvar_map,
+        intersecting the index entries from the smallest.
+        '''
+        if not pvar_map:
+            return list(self.matches.values())
+        entries = []
+        for pair in pvar_map:
+            pmatches = self.index.get(self._key(pair))
+            if not pmatches:
+                return []
+            entries.append(pmatches)
+        entries.sort(key=len)
+        first, rest = entries[0], entries[1:]
+        return [self.matches[pm] for pm in first
+                if all(pm in other for other in rest)]
+
+
+class DBMemory(object):
+    '''
+    Like a BetaMemory, but looking up the matches in the db each time,
+    with a probe of the mpair indexes for each bound variable.
+    '''
+
+    def __init__(self, pnid, network):
+        self.pnid = pnid
+        self.network = network
+
+    def __len__(self):
+        q = self.network.session.query(PMatch).filter(PMatch.prem_id==self.pnid)
+        return q.count()
+
+    def add(self, pmatch, pairs):
+        pass
+
+    def remove(self, pmatch):
+        pass
+
+    def lookup(self, pvar_map):
+        session = self.network.session
+        session.flush()
+        q = session.query(PMatch.id).filter(PMatch.prem_id==self.pnid)
+        for var, val in pvar_map:
+            pair = MPair.__table__.alias()
+            col = pair.c.pred_id if isinstance(val, Predicate) else pair.c.term_id
+            q = q.join(pair, pair.c.parent_id==PMatch.id)
+            q = q.filter((pair.c.prem_id==self.pnid) & (pair.c.var==var) & (col==val.id))
+        pmids = [pmid for pmid, in q.order_by(PMatch.id)]
+        bindings = self.network.load_bindings(self.pnid, pmids)
+        return [bindings.get(pmid, {}) for pmid in pmids]
+
+
 class PremNode(Base):
     '''
     a terminal node for a premise
@@ -516,6 +1348,9 @@ class PremNode(Base):
 
     id = Column(Integer, Sequence('premnode_id_seq'), primary_key=True)
     parent_id = Column(Integer, ForeignKey('nodes.id'), index=True)
+    # counter of the changes to its matches,
+    # so that each process can tell whether its memory of them is stale
+    generation = Column(Integer, default=0)
     parent = relationship('Node', backref=backref('terminal', uselist=False,
                                                   cascade='all,delete-orphan'),
                          primaryjoin="Node.id==PremNode.parent_id")
@@ -529,17 +1364,16 @@ class PremNode(Base):
 
     def dispatch(self, match, network):
         logger.debug('this has matched: {!r}'.format(match))
-        if not self.prems[0].check_match(match, network):
+        programs = network.get_programs(self.id)
+        if not programs or not programs[0][0].check_match(programs[0][1], match):
             return
         m = PMatch(self, match.fact)
         for var, val in match.items():
-            m.pairs.append(MPair.make_pair(var, val))
-        for premise in self.prems:
-            nmatch = premise.num_to_names(match)
-            premise.dispatch(nmatch, network)
+            m.pairs.append(MPair.make_pair(self, var, val))
+        network.remember(self, m, dict(match))
+        for program, n in programs:
+            program.activate(n, program.num_to_names(n, match), network)
 
-from sqlalchemy.sql import select
-from sqlalchemy.sql.expression import Select
 
 class NoMatches(Exception):
     pass
@@ -568,110 +1402,6 @@ class Premise(Base):
         self.order = order
         self.pred = pred
 
-    def check_match(self, match, network):
-        pred = self.pred
-        prem_paths = network.present.get_paths(pred)
-        for p in prem_paths:
-            if p[-1] == '_num':
-                p = p[:-1] + ('_term',)
-            if p not in match.paths:
-                return False
-        return True
-
-    def num_to_names(self, match):
-        nmatch = match.copy()
-        for num, o in match.items():
-            pvar = tuple(filter(lambda x: x.rule==self.rule and x.num==num, self.pvars))[0]
-            name = pvar.varname.name
-            nmatch[name] = o
-            del nmatch[num]
-        return nmatch
-
-    def name_to_num(self, name):
-        pvar = tuple(filter(lambda x: x.varname.name==name, self.pvars))[0]
-        return pvar.num
-
-    def dispatch(self, match, network):
-        logger.debug('match: {!r}'.format(match))
-        prems = [p for p in self.rule.prems if p != self]
-        try:
-            if prems:
-                matches = self.recurse_premises(match, prems, network)
-                logger.debug('matches: {!r}'.format(matches))
-            else:
-                matches = [match]
-        except NoMatches:
-            return
-        for m in matches:
-            self.rule.dispatch(m, network)
-
-    def recurse_premises(self, match, remaining_prems, network):
-        prem, pmatches = self.pick_prem(remaining_prems, match, network)
-        logger.debug('picked {!r}, pmatches {!r}'.format(prem, pmatches))
-        remaining_prems.remove(prem)
-        matches = []
-        for pm in pmatches:
-            new_match = match.copy()
-            for mpair in pm.pairs:
-                vname = self.rule.get_varname(prem, mpair.var)
-                if vname not in new_match:
-                    new_match[vname] = mpair.val
-            try:
-                passes = self.rule.test_conditions(new_match, network)
-            except KeyError:
-                passes = True
-            if passes:
-                matches.append(new_match)
-        if not remaining_prems:
-            return matches
-        else:
-            new_matches = []
-            for m in matches:
-                try:
-                    new_matches += self.recurse_premises(m, remaining_prems[:], network)
-                except NoMatches:
-                    pass
-            return new_matches
-
-    def pick_prem(self, prems, match, network):
-        count, pmatches, picked = float('inf'), None, None
-        prems.sort(key=lambda p: p.node.matches.count())
-        for prem in prems:
-            pms = prem.filter_pmatches(match, network)
-            newcount = pms.count() if pms else 0
-            if newcount == 0:
-                raise NoMatches
-            elif newcount == 1:
-                return prem, pms
-            if newcount < count:
-                count, pmatches, picked = newcount, pms, prem
-        return picked, pmatches
-
-    def filter_pmatches(self, match, network):
-        pmatches = self.node.matches
-        pvar_map = self.rule.get_pvar_map(match, self)
-        subqueries = []
-        for var, val in pvar_map:
-            apair = aliased(MPair)
-            if isinstance(val, Predicate):
-                cpair = aliased(PPair.__table__)
-                ccol = cpair.c.pred_id
-            else:
-                cpair = aliased(TPair.__table__)
-                ccol = cpair.c.term_id
-            subquery = select([apair.parent_id], from_obj=[apair, cpair], whereclause=(apair.var==var)&(ccol==val.id)&(apair.id==cpair.c.mid), distinct=True)
-            subqueries.append(subquery)
-        if subqueries:
-            def count_subquery(q):
-                n = network.session.execute(aliased(q).count()).scalar()
-                if n == 0:
-                    raise NoMatches
-                return n
-            subqueries.sort(key=count_subquery)
-            subquery = functools.reduce(Select.intersect, subqueries)
-            pmatches = pmatches.filter(PMatch.id.in_(subquery)).distinct(PMatch.id)
-        return pmatches
-
 
 class PMatch(Base):
     __tablename__ = 'pmatchs'
@@ -695,6 +1425,12 @@ class PMatch(Base):
 
 
 class MPair(Base):
+    '''
+    The value of a numbered variable in a PMatch.
+    The premnode of the match is repeated in the pair,
+    so that the matches with a given value for a variable
+    can be looked up with a single index.
+    '''
     __tablename__ = 'mpairs'
 
     id = Column(Integer, Sequence('mpair_id_seq'), primary_key=True)
@@ -702,41 +1438,42 @@ class MPair(Base):
     parent = relationship('PMatch', backref=backref('pairs',
                                                     cascade='all,delete-orphan'),
                          primaryjoin="PMatch.id==MPair.parent_id")
-    var = Column(Integer, index=True)
-    mindex = Index('mindex', 'id', 'parent_id')
+    prem_id = Column(Integer, ForeignKey('premnodes.id'))
+    var = Column(Integer)
 
     mtype = Column(Integer)
-    __mapper_args__ = {'polymorphic_on': mtype,
-                       'with_polymorphic': '*'}
+    __mapper_args__ = {'polymorphic_on': mtype}
 
-    def __init__(self, var, val):
+    def __init__(self, prem, var, val):
+        self.prem_id = prem.id
         self.var = var
         self.val = val
 
     @classmethod
-    def make_pair(cls, var, val):
+    def make_pair(cls, prem, var, val):
         if isinstance(val, Predicate):
-            return PPair(var, val)
+            return PPair(prem, var, val)
         else:
-            return TPair(var, val)
+            return TPair(prem, var, val)
+
 
 class TPair(MPair):
-    __tablename__ = 'tpairs'
     __mapper_args__ = {'polymorphic_identity': 0}
-    mid = Column(Integer, ForeignKey('mpairs.id'), primary_key=True)
-    term_id = Column(Integer, ForeignKey('terms.id'), index=True)
+    term_id = Column(Integer, ForeignKey('terms.id'))
     val = relationship('Term', primaryjoin="Term.id==TPair.term_id")
-    tindex = Index('tindex', 'mid', 'term_id')
 
 
 class PPair(MPair):
-    __tablename__ = 'ppairs'
     __mapper_args__ = {'polymorphic_identity': 1}
-    mid = Column(Integer, ForeignKey('mpairs.id'), primary_key=True)
-    pred_id = Column(Integer, ForeignKey('predicates.id'), index=True)
+    pred_id = Column(Integer, ForeignKey('predicates.id'))
     val = relationship('Predicate',
                          primaryjoin="Predicate.id==PPair.pred_id")
-    pindex = Index('pindex', 'mid', 'pred_id')
+
+
+for name, col in (('term', 'term_id'), ('pred', 'pred_id')):
+    Index('mpair_{}_index'.format(name), MPair.__table__.c.prem_id,
+          MPair.__table__.c.var, MPair.__table__.c[col],
+          MPair.__table__.c.parent_id)
 
 
 class PVarname(Base):
@@ -804,77 +1541,6 @@ class Rule(Base):
 
     id = Column(Integer, Sequence('rule_id_seq'), primary_key=True)
 
-    def test_conditions(self, match, network):
-        for cond in self.conditions:
-            if not cond.test(match, network):
-                return False
-        return True
-
-    def dispatch(self, match, network):
-
-        if not self.test_conditions(match, network):
-            return
-
-        if self.condcode:
-            if not self.condcode.test(match, network):
-                return
-
-
-        cons = []
-        for con in self.consecuences:
-            cons.append(con.substitute(match))
-
-        for con in self.vconsecuences:
-            new_pred = match[con.name].copy()
-            cons.append(new_pred)
-
-        for con in cons:
-            factset = network.present
-            if isa(con, network.lexicon.exclusive_endure):
-                old_pred = Predicate(con.true, con.term_type)
-                old_pred.add_object('subj', con.get_object('subj'))
-                for label in con.objects:
-                    if label.startswith('u-'):
-                        old_pred.add_object(label, con.get_object(label))
-                network.finish(old_pred)
-            elif isa(con, network.lexicon.finish):
-                tofinish = con.get_object('what')
-                network.finish(tofinish)
-            # XXX make contradiction configurabe
-            #neg = con.copy()
-            #neg.true = not neg.true
-            #contradiction = factset.query(neg)
-            #if contradiction:
-            #    raise exceptions.Contradiction('we already have ' + str(neg))
-            if factset.query_facts(con, {}).count() == 0:
-                if isa(con, network.lexicon.endure):
-                    con.add_object('since_', network.lexicon.now_term)
-                fact = factset.add_fact(con)
-                if isa(con, network.lexicon.happen):
-                    if network.pipe is not None:
-                        network.pipe.send_bytes(str(con).encode('utf8'))
-                if network.root.child_path:
-                    logger.debug('con to add: ' + str(con))
-                    m = Match(con)
-                    m.paths = network.get_paths(con)
-                    logger.debug('con in fact: ' + str(fact.pred))
-                    m.fact = fact
-                    network.activations.append(m)
-
-    def get_pvar_map(self, match, prem):
-        pvar_map = []
-        for name, val in match.items():
-            pvars = filter(lambda x: x.prem==prem and x.varname.var.name==name, self.pvars)
-            for n, pvar in enumerate(pvars):
-                pvar_map.append((pvar.num, val))
-                if n > 1:
-                    raise exceptions.Corruption('should not happen')
-        return pvar_map
-
-    def get_varname(self, prem, num):
-        pvar = tuple(filter(lambda x: x.prem==prem and x.num==num, self.pvars))[0]
-        return pvar.varname.name
-
 
 class CondArg(Base):
     '''
@@ -945,16 +1611,22 @@ class CondCode(Base):
                          primaryjoin="Rule.id==CondCode.rule_id")
     code = Column(String)
 
-    def test(self, match, network):
+    def get_code(self):
+        '''
+        Compile the condition into a code object, to run with test.
+        '''
+        return compile(self.code, '<condition of rule {}>'.format(self.rule_id), 'exec')
+
+    @staticmethod
+    def test(code, match, network):
+        lexicon = network.lexicon
         exec_locals = {'condition': True}
         exec_locals['match'] = match
         for k, v in match.items():
-            if getattr(v, 'number', False):
-                exec_locals[k] = eval(v.name, {}, {})
-            else:
-                exec_locals[k] = v
+            value = lexicon.number_value(v)
+            exec_locals[k] = v if value is None else value
         try:
-            exec(self.code, localdata.exec_globals, exec_locals)
+            exec(code, localdata.exec_globals, exec_locals)
         except Exception:
             if exec_locals['condition']:
                 raise
@@ -964,10 +1636,211 @@ class CondCode(Base):
             if k in ('condition', '__builtins__', 'match'):
                 continue
             try:
-                match[k] = network.lexicon.make_term(str(0 + v), network.lexicon.number)
+                match[k] = lexicon.number_term(v)
             except TypeError:
                 pass
         return exec_locals['condition']
 
     def __init__(self, code):
         self.code = code
+
+
+class RuleProgram(object):
+    '''
+    A rule compiled for the dispatch of its matches:
+    for each premise (by order), the tables between its numbered variables
+    and the names of the variables of the rule,
+    the paths that a match must have, and the id of its premnode;
+    and the conditions (with the code condition compiled)
+    and consecuences of the rule, with no need to walk the relationships of the rule in the db.
+    It is built once by the network, and not changed after that.
+    '''
+
+    def __init__(self, rule, network):
+        self.rule_id = rule.id
+        prems = sorted(rule.prems, key=lambda p: p.order)
+        self.pnodes = tuple(p.prem_id for p in prems)
+        names = [{} for p in prems]
+        for pvar in rule.pvars:
+            names[pvar.prem.order][pvar.num] = pvar.varname.name
+        self.names = tuple(names)
+        self.nums = tuple({name: num for num, name in ns.items()} for ns in names)
+        paths = []
+        for prem in prems:
+            ppaths = set()
+            for path in network.get_paths(prem.pred):
+                if path[-1] == '_num':
+                    path = path[:-1] + ('_term',)
+                ppaths.add(path)
+            paths.append(frozenset(ppaths))
+        self.paths = tuple(paths)
+        conditions = []
+        for cond in rule.conditions:
+            test = are if isinstance(cond, CondIs) else isa
+            args = tuple((a.term.name if a.term.var else None, a.term)
+                         for a in cond.args)
+            conditions.append((test, args))
+        self.conditions = tuple(conditions)
+        self.condcode = rule.condcode and rule.condcode.get_code()
+        self.consecuences = tuple(self._template(con) for con in rule.consecuences)
+        self.vconsecuences = tuple(con.name for con in rule.vconsecuences)
+
+    def _template(self, pred):
+        '''
+        Turn a consecuence into nested tuples:
+        (true, verb, name of verb var or None, ((label, kind, value), ...)),
+        with kind 'pred' for a nested template,
+        'var' for the name of a variable, and 'term' for a word.
+        '''
+        verb = pred.term_type
+        objs = []
+        for o in pred.objects.values():
+            if isinstance(o.value, Predicate):
+                objs.append((o.label, 'pred', self._template(o.value)))
+            elif o.value.var:
+                objs.append((o.label, 'var', o.value.name))
+            else:
+                objs.append((o.label, 'term', o.value))
+        return (pred.true, verb, verb.name if verb.var else None, tuple(objs))
+
+    def _substitute(self, template, match):
+        true, verb, verb_var, objs = template
+        new = Predicate(true, match[verb_var] if verb_var else verb)
+        for label, kind, value in objs:
+            if kind == 'pred':
+                value = self._substitute(value, match)
+            elif kind == 'var':
+                value = match[value]
+            new.add_object(label, value)
+        return new
+
+    def check_match(self, n, match):
+        return self.paths[n].issubset(match.paths)
+
+    def num_to_names(self, n, match):
+        nmatch = match.copy()
+        names = self.names[n]
+        for num, o in match.items():
+            nmatch[names[num]] = o
+            del nmatch[num]
+        return nmatch
+
+    def name_to_num(self, n, name):
+        return self.nums[n][name]
+
+    def activate(self, n, match, network):
+        '''
+        Join a match for the n-th premise (with named variables)
+        with the matches for the rest, and fire the rule for each result.
+        '''
+        logger.debug('match: {!r}'.format(match))
+        prems = [m for m in range(len(self.pnodes)) if m != n]
+        try:
+            if prems:
+                matches = self._recurse_premises(match, prems, network)
+                logger.debug('matches: {!r}'.format(matches))
+            else:
+                matches = [match]
+        except NoMatches:
+            return
+        for m in matches:
+            self.fire(m, network)
+
+    def _recurse_premises(self, match, remaining_prems, network):
+        prem, pmatches = self._pick_prem(remaining_prems, match, network)
+        logger.debug('picked {!r}, pmatches {!r}'.format(prem, pmatches))
+        remaining_prems.remove(prem)
+        names = self.names[prem]
+        matches = []
+        for pairs in pmatches:
+            new_match = match.copy()
+            for var, val in pairs.items():
+                vname = names[var]
+                if vname not in new_match:
+                    new_match[vname] = val
+            try:
+                passes = self.test_conditions(new_match)
+            except KeyError:
+                passes = True
+            if passes:
+                matches.append(new_match)
+        if not remaining_prems:
+            return matches
+        else:
+            new_matches = []
+            for m in matches:
+                try:
+                    new_matches += self._recurse_premises(m, remaining_prems[:], network)
+                except NoMatches:
+                    pass
+            return new_matches
+
+    def _pick_prem(self, prems, match, network):
+        count, pmatches, picked = float('inf'), None, None
+        prems.sort(key=lambda p: len(network.get_memory(self.pnodes[p])))
+        for prem in prems:
+            pms = self._filter_pmatches(prem, match, network)
+            newcount = len(pms)
+            if newcount == 0:
+                raise NoMatches
+            elif newcount == 1:
+                return prem, pms
+            if newcount < count:
+                count, pmatches, picked = newcount, pms, prem
+        return picked, pmatches
+
+    def _filter_pmatches(self, prem, match, network):
+        nums = self.nums[prem]
+        pvar_map = [(nums[name], val) for name, val in match.items() if name in nums]
+        return network.get_memory(self.pnodes[prem]).lookup(pvar_map)
+
+    def test_conditions(self, match):
+        for test, args in self.conditions:
+            values = [match[name] if name else term for name, term in args]
+            if not test(*values):
+                return False
+        return True
+
+    def fire(self, match, network):
+        '''
+        Test the conditions of the rule for a complete match,
+        and add its consecuences.
+        '''
+        if not self.test_conditions(match):
+            return
+
+        if self.condcode:
+            if not CondCode.test(self.condcode, match, network):
+                return
+
+        cons = []
+        for con in self.consecuences:
+            cons.append(self._substitute(con, match))
+
+        for name in self.vconsecuences:
+            new_pred = match[name].copy()
+            cons.append(new_pred)
+
+        for con in cons:
+            factset = network.present
+            network.finish_previous(con)
+            # XXX make contradiction configurabe
+            #neg = con.copy()
+            #neg.true = not neg.true
+            #contradiction = factset.query(neg)
+            #if contradiction:
+            #    raise exceptions.Contradiction('we already have ' + str(neg))
+            if not factset.find_facts([con]):
+                if isa(con, network.lexicon.endure):
+                    con.add_object('since_', network.lexicon.now_term)
+                fact = factset.add_fact(con)
+                if isa(con, network.lexicon.happen):
+                    if network.pipe is not None:
+                        network.pipe.send_bytes(str(con).encode('utf8'))
+                if network.root.child_path:
+                    logger.debug('con to add: ' + str(con))
+                    m = Match(fact.pred)
+                    m.paths = network.get_paths(fact.pred)
+                    logger.debug('con in fact: ' + str(fact.pred))
+                    m.fact = fact
+                    network.activations.append(m)
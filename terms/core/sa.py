@@ -9,7 +9,7 @@ from terms.core.terms import Base
 def get_sasession(config):
     address = '%s/%s' % (config['dbms'], config['dbname'])
     engine = create_engine(address)
-    Session = sessionmaker(bind=engine)
+    Session = sessionmaker(bind=engine, expire_on_commit=False)
     if config['dbname'] == ':memory:':
         session = Session()
         Base.metadata.create_all(engine)
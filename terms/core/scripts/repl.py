@@ -37,7 +37,7 @@ class TermsRepl(object):
                 pass
         address = '%s/%s' % (config['dbms'], config['dbname'])
         engine = create_engine(address)
-        Session = sessionmaker(bind=engine)
+        Session = sessionmaker(bind=engine, expire_on_commit=False)
         if config['dbname'] == ':memory:':
             from terms.core.terms import Base
             Base.metadata.create_all(engine)
@@ -71,7 +71,16 @@ class TermsRepl(object):
                  for r in res]
         return '; '.join(resps)
 
+    def _load_facts(self, path):
+        with open(os.path.expanduser(path)) as f:
+            code = f.read()
+        return self.compiler.parse_facts(code)
+
     def process_line(self, line):
+        if not self._buffer and line.startswith('facts:'):
+            return self._load_facts(line[6:].strip())
+        if not self._buffer and line.startswith('explain:'):
+            return self.compiler.explain(line[8:])
         self.prompt = '.. '
         resp = self.no_response
         if line:
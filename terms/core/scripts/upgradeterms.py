@@ -0,0 +1,45 @@
+import sys
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+
+from terms.core.utils import get_config
+from terms.core.network import Network
+from terms.core.terms import Base
+
+
+def upgrade(engine, config):
+    '''
+    Bring the db of a knowledge base made by an older version of terms
+    up to date: create the tables it lacks,
+    add the columns it lacks to the tables it has,
+    fill them in, and then create the indexes it lacks.
+    It can be run more than once.
+    '''
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        columns = {c['name'] for c in inspector.get_columns(table.name)}
+        for col in table.columns:
+            if col.name not in columns:
+                engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    quote(table.name), quote(col.name), col.type.compile(engine.dialect)))
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    Network.upgrade(session, config)
+    session.commit()
+    session.close()
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(engine)
+
+
+def upgrade_terms():
+    config = get_config()
+    address = '%s/%s' % (config['dbms'], config['dbname'])
+    upgrade(create_engine(address), config)
+    sys.exit(0)
@@ -20,9 +20,10 @@
 import datetime
 
 from sqlalchemy import Table, Column, Sequence, Index, DateTime
-from sqlalchemy import ForeignKey, Integer, String, Boolean, Text
+from sqlalchemy import ForeignKey, Integer, BigInteger, String, Boolean, Text
+from sqlalchemy import sql
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, object_session
 from sqlalchemy.orm.collections import attribute_mapped_collection
 
 from terms.core.exceptions import WrongLabel
@@ -39,6 +40,22 @@ term_to_base = Table('term_to_base', Base.metadata,
     Column('base_id', Integer, ForeignKey('terms.id'))
 )
 
+# transitive closure of term_to_base, including each term as its own ancestor
+term_closure = Table('term_closure', Base.metadata,
+    Column('ancestor_id', Integer, ForeignKey('terms.id')),
+    Column('descendant_id', Integer, ForeignKey('terms.id')),
+    Index('term_closure_anc_index', 'ancestor_id', 'descendant_id'),
+    Index('term_closure_desc_index', 'descendant_id', 'ancestor_id'),
+)
+
+# intervals that a term covers, besides its own,
+# for descendants reached through bases other than the first one
+term_intervals = Table('term_intervals', Base.metadata,
+    Column('term_id', Integer, ForeignKey('terms.id'), index=True),
+    Column('lft', BigInteger),
+    Column('rgt', BigInteger),
+)
+
 term_to_objtype = Table('term_to_objtype', Base.metadata,
     Column('term_id', Integer, ForeignKey('terms.id')),
     Column('objtype_id', Integer, ForeignKey('objecttypes.id'))
@@ -65,6 +82,12 @@ class Term(Base):
     equals = ()
     var = Column(Boolean)
     number = Column(Boolean, default=False)
+    # interval labels in the spanning tree of the taxonomy
+    # (the tree that follows the first base of each term),
+    # and start of the part of the interval free for new subterms.
+    lft = Column(BigInteger)
+    rgt = Column(BigInteger)
+    free = Column(BigInteger)
 
     rule_id = Column(Integer, ForeignKey('rules.id'))
     rule = relationship('Rule', backref=backref('vconsecuences', cascade='all'),
@@ -86,6 +109,7 @@ class Term(Base):
         self.var = var
         self._sup_cache = None
         self._sub_cache = None
+        self._intervals = None
         if not _bootstrap:
             self.term_type = ttype or bases[0].term_type
         used = []
@@ -113,23 +137,15 @@ class Term(Base):
         #  immutable
         return self
 
-    def purge_cache(self, lexicon):
-        for sub in lexicon.get_subterms(self):
-            sub.purge_sup()
-        for sup in get_bases(self):
-            sup.purge_sub(lexicon)
-
-    def purge_sup(self):
+    def add_to_caches(self):
+        '''
+        Add a new term, that can only be a leaf in the taxonomy,
+        to the cached subterms of its ancestors.
+        '''
         for sup in get_bases(self):
-            sup.purge_sup()
-        self._sup_cache = None
-
-    def purge_sub(self, lexicon):
-        for sub in lexicon.get_subterms(self):
-            if sub is self:
-                continue
-            sub.purge_sub(lexicon)
-        self._sub_cache = None
+            cache = getattr(sup, '_sub_cache', None)
+            if cache is not None:
+                sup._sub_cache = cache + (self,)
 
 
 class ObjectType(Base):
@@ -256,6 +272,7 @@ class Object(Base):
 
     otype = Column(Integer)
     __mapper_args__ = {'polymorphic_on': otype}
+    __table_args__ = (Index('object_parent_index', 'parent_id', 'label'),)
 
     def __init__(self, label, term):
         self.label = label
@@ -295,6 +312,14 @@ def isa(t1, t2):
 def are(t1, t2):
     if t1 == t2:
         return True
+    lft = getattr(t1, 'lft', None)
+    if lft is not None and getattr(t2, 'lft', None) is not None:
+        if t2.lft <= lft <= t2.rgt:
+            return True
+        if any(l <= lft <= r for l, r in get_intervals(t2)):
+            return True
+        if not (t1.equals or any(b.equals for b in get_bases(t1))):
+            return False
     try:
         equals = get_equals(t1, search=t2)
         for eq in equals:
@@ -318,10 +343,44 @@ def get_bases(term, search=None):
         if search and search in cache:
             raise SearchFound(search)
         return cache
-    bases = _get_desc(term, 'bases', search=search)
+    bases = _get_ancestors(term)
+    if bases is None:
+        bases = _get_desc(term, 'bases', search=search)
+    elif search and search in bases:
+        raise SearchFound(search)
     term._sup_cache = bases
     return bases
 
+def _get_ancestors(term):
+    '''
+    Get the ancestors of a persistent term from the closure table,
+    or None if it is not there.
+    '''
+    session = object_session(term)
+    if session is None or term.id is None:
+        return None
+    with session.no_autoflush:
+        q = session.query(Term).join(term_closure, Term.id==term_closure.c.ancestor_id)
+        ancestors = q.filter(term_closure.c.descendant_id==term.id).all()
+    if not ancestors:
+        return None
+    ancestors = [a for a in ancestors if a is not term]
+    equals = [eq for a in ancestors for eq in a.equals]
+    return tuple(set(ancestors + equals)) if equals else tuple(ancestors)
+
+def get_intervals(term):
+    '''
+    Get the intervals that term covers besides its own.
+    '''
+    intervals = getattr(term, '_intervals', None)
+    if intervals is None:
+        session = object_session(term)
+        q = sql.select([term_intervals.c.lft, term_intervals.c.rgt])
+        q = q.where(term_intervals.c.term_id==term.id)
+        intervals = [tuple(row) for row in session.execute(q)]
+        term._intervals = intervals
+    return intervals
+
 def get_equals(term, search=None):
     return (term,) + _get_desc(term, 'equals', search=search)
 
@@ -352,6 +411,87 @@ class Time(Base):
     now = Column(Integer, default=0)
 
 
+class Generation(Base):
+    '''
+    Counters of the changes made to the lexicon and to the network,
+    so that each process can tell whether its caches are stale.
+    '''
+    __tablename__ = 'generation'
+    id = Column(Integer, default=0, primary_key=True)
+    lexicon = Column(Integer, default=0)
+    network = Column(Integer, default=0)
+
+    @classmethod
+    def get(cls, session):
+        '''
+        Return the current (lexicon, network) counters.
+        '''
+        table = cls.__table__
+        q = sql.select([table.c.lexicon, table.c.network])
+        return tuple(session.execute(q).first())
+
+    # number of generations of each counter whose changes are kept
+    keep = 1000
+
+    @classmethod
+    def bump(cls, session, name, ids=()):
+        '''
+        Increment one of the counters, within the current transaction,
+        recording the ids of the terms or nodes changed,
+        or that anything may have changed, if there are none.
+        '''
+        table = cls.__table__
+        session.execute(table.update().values({name: table.c[name] + 1}))
+        generation = session.execute(sql.select([table.c[name]])).scalar()
+        changes = GenerationChange.__table__
+        rows = [{'counter': name, 'generation': generation, 'ref_id': ref_id}
+                for ref_id in ids or (None,)]
+        session.execute(changes.insert(), rows)
+        if generation % 100 == 0:
+            session.execute(changes.delete().where(sql.and_(
+                changes.c.counter==name,
+                changes.c.generation <= generation - cls.keep)))
+
+    @classmethod
+    def changes(cls, session, name, since, until):
+        '''
+        Get the ids of the terms or nodes changed
+        in the generations of a counter after since and up to until,
+        or None if what changed is not known,
+        because it was not recorded or has been forgotten.
+        '''
+        if since < 0:
+            return None
+        changes = GenerationChange.__table__
+        q = sql.select([changes.c.generation, changes.c.ref_id])
+        q = q.where(sql.and_(changes.c.counter==name,
+                             changes.c.generation > since,
+                             changes.c.generation <= until))
+        generations, ids = set(), set()
+        for generation, ref_id in session.execute(q):
+            if ref_id is None:
+                return None
+            generations.add(generation)
+            ids.add(ref_id)
+        if len(generations) != until - since:
+            return None
+        return ids
+
+
+class GenerationChange(Base):
+    '''
+    Ids of the terms or nodes changed in each generation
+    of the counters of the lexicon and of the network.
+    '''
+    __tablename__ = 'generation_changes'
+    id = Column(Integer, Sequence('generation_change_id_seq'), primary_key=True)
+    counter = Column(String(8))
+    generation = Column(Integer)
+    ref_id = Column(Integer)
+
+    __table_args__ = (Index('generation_change_index', 'counter', 'generation'),)
+
+
 class Import(Base):
     '''
     '''
@@ -379,8 +519,31 @@ class ExecGlobal(Base):
         self.code = code
 
 
-def load_exec_globals(session):
-    egs = session.query(ExecGlobal).all()
+class PreparedQuestion(Base):
+    '''
+    Questions registered by name, with variables given as parameters,
+    so that every process can build the same prepared statements.
+    '''
+    __tablename__ = 'preparedquestions'
+    id = Column(Integer, Sequence('preparedquestion_id_seq'), primary_key=True)
+    name = Column(String, unique=True)
+    params = Column(String)
+    code = Column(Text())
+
+    def __init__(self, name, code, params):
+        self.name = name
+        self.code = code
+        self.params = params
+
+
+def load_exec_globals(session, since=0):
+    '''
+    Execute the exec globals with ids above since,
+    and return the highest id executed so far.
+    '''
+    egs = session.query(ExecGlobal).filter(ExecGlobal.id > since)
     from terms.core import localdata
-    for eg in egs:
+    for eg in egs.order_by(ExecGlobal.id):
         exec(eg.code, localdata.exec_globals)
+        since = eg.id
+    return since
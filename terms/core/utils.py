@@ -22,6 +22,7 @@ import os
 import os.path
 import sys
 import logging
+from collections import OrderedDict, deque
 from configparser import ConfigParser
 from optparse import OptionParser
 
@@ -70,29 +71,100 @@ class Match(dict):
         return new_match
 
 
+class LRUCache(OrderedDict):
+    '''
+    Dict that keeps at most size items (any number if size is 0),
+    evicting the least recently used.
+    '''
+
+    def __init__(self, size=0):
+        self.size = size
+        super(LRUCache, self).__init__()
+
+    def __getitem__(self, key):
+        value = super(LRUCache, self).__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super(LRUCache, self).__setitem__(key, value)
+        self.move_to_end(key)
+        if self.size and len(self) > self.size:
+            self.popitem(last=False)
+
+
+class Agenda(deque):
+    '''
+    Queue of the matches for new facts waiting to be pushed
+    through the network, taken first in first out ('fifo' strategy),
+    breadth first through the consecuences of a fact,
+    or last in first out ('lifo'), depth first.
+    It keeps the most matches it has held as high_water.
+    '''
+    strategies = ('fifo', 'lifo')
+
+    def __init__(self, strategy='fifo'):
+        if strategy not in self.strategies:
+            raise ValueError('Unknown agenda strategy: ' + strategy)
+        self.strategy = strategy
+        self.high_water = 0
+        super(Agenda, self).__init__()
+
+    def append(self, match):
+        super(Agenda, self).append(match)
+        if len(self) > self.high_water:
+            self.high_water = len(self)
+
+    def pop(self):
+        if self.strategy == 'fifo':
+            return self.popleft()
+        return super(Agenda, self).pop()
+
+
 def merge_submatches(submatches):
-    final = []
-    while submatches:
-        final = submatches.pop()
-        if not final:
-            return final
-        elif not final[0]:
-            continue
-        break
-    while submatches:
-        sm = submatches.pop()
+    '''
+    Join the lists of matches for the facts in a question
+    on the variables they share.
+    A list without matches makes the join empty,
+    and lists whose matches have no variables (facts without variables)
+    are ignored.
+    The lists are joined smallest first, through hash tables keyed
+    by the values of the shared variables, and the result is sorted
+    as a nested loop over the lists, in the order given, would give it.
+    '''
+    lists = []
+    for n, sm in enumerate(submatches):
         if not sm:
             return sm
-        elif not sm[0]:
-            continue
+        elif sm[0]:
+            lists.append((len(sm), n, sm))
+    if not lists:
+        return submatches[0] if submatches else []
+    lists.sort(key=lambda x: x[:2])
+    order = [n for _, n, _ in lists]
+    final = [((i,), m) for i, m in enumerate(lists[0][2])]
+    for _, n, sm in lists[1:]:
+        if not final:
+            return []
+        shared = tuple(set(final[0][1]).intersection(sm[0]))
+        table = {}
+        for i, m in enumerate(sm):
+            table.setdefault(tuple(m[k] for k in shared), []).append((i, m))
         new = []
-        for n in sm:
-            for m in final:
-                nm = m.merge(n)
-                if nm:
-                    new.append(nm)
+        for idx, m in final:
+            for i, m2 in table.get(tuple(m[k] for k in shared), ()):
+                new.append((idx + (i,), m.merge(m2)))
         final = new
-    return final
+    positions = sorted(range(len(order)), key=lambda p: order[p])
+    final.sort(key=lambda x: tuple(x[0][p] for p in positions))
+    return [m for _, m in final]
+
+
+def binding_key(match):
+    '''
+    Hashable key for the bindings of a match.
+    '''
+    return frozenset(match.items())
 
 
 def get_config(cmd_line=True):